@@ -2,29 +2,46 @@
 # last 25 battles, how many are war, and show win ratio, etc.
 import sys
 import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from decouple import config
+from decouple import config, Csv
 
-import db
+import battlelog
+import storage
 import crlib as cr
-import requests
 
+import metrics
 import spreadsheet
+from notifier import notifier
 from utils import log, err
 
 # don't run CR API queries; don't save to Google sheets; print report to stdout
 REPORT_DEBUG = False
 REPORT_HOURS = [] # [17, 19, 22, 8]
+# number of players whose data is requested from CR API simultaneously
+FETCH_WORKERS = config('FETCH_WORKERS', default=8, cast=int)
+# report tabs exported on every run: `week` (since the previous Sunday, exported to the Stats sheet), `season`
+# and `<N>w` (last N weeks); with SEASON_SUMMARY per player season totals are exported to Season Summary sheet
+REPORT_WINDOWS = config('REPORT_WINDOWS', default='week', cast=Csv())
+SEASON_SUMMARY = config('SEASON_SUMMARY', default=False, cast=bool)
+# seconds one-shot run waits for Discord notification to be sent before exiting
+NOTIFICATION_FLUSH_TIMEOUT = config('NOTIFICATION_FLUSH_TIMEOUT', default=120, cast=int)
 
 
 class ClanData:
+    __slots__ = ('battles_won', 'battles_played')
+
     def __init__(self):
         self.battles_won = 0
         self.battles_played = 0
 
 
 # The stats for a single player, war day won, lost, 
+# there is one per clan member in every run, so no instance __dict__
 class PlayerStats:
+    __slots__ = ('id', 'name', 'battles_won', 'battles_played', 'boat_attacks', 'limited_info')
+
     def __init__(self):
         self.id = None
         self.name = ""
@@ -47,6 +64,11 @@ def _get_war_day(dt, formatted=True):
         return res
 
 
+# returns the moment the war day of `dt` ends
+def get_war_day_end(dt):
+    return datetime.datetime.combine(_get_war_day(dt, False) + datetime.timedelta(days=1), datetime.time(10))
+
+
 def _get_war_start_prefix():
     today = datetime.datetime.utcnow()
     # before 10 am gmt look for the previous day :)
@@ -59,106 +81,107 @@ def _get_war_start_prefix():
     return timestamp
 
 
-# parses datetime format of the CR API
-def _parse_cr_date(datetime_string):
-    return datetime.datetime.strptime(datetime_string, '%Y%m%dT%H%M%S.%fZ')
-
-
-def _save_battle(player, cr_timestamp, battles, won):
-    dt = _parse_cr_date(cr_timestamp)
-    war_day = _get_war_day(dt)
-    db.save_battle(player.id, dt, war_day, battles, battles if won else 0, 0)
-
-
-# Per player gather war battles, and update clan level player stats
-def populate_war_games(clan_tag, player_tag, war_start_time, player):
-    def get_towers_count(t):
-        return (1 if "kingTowerHitPoints" in t and t["kingTowerHitPoints"] else 0) + \
-               (len(t["princessTowersHitPoints"]) if "princessTowersHitPoints" in t else 0)
-
-    r2 = requests.get("https://api.clashroyale.com/v1/players/%23" + player_tag + "/battlelog",
-                      headers={"Accept": "application/json", "authorization": cr.auth},
-                      params={"limit": 100})
-    battles = r2.json()
-    # Types are: (NOT complete, there may be many others)
-    # boatBattle
-    # casual1v1
-    # casual2v2
-    # challenge
-    # clanMate
-    # clanMate2v2
-    # friendly
-    # None
-    # PvP
-    # riverRaceDuel
-    # riverRacePvP
-    # riverRaceDuelColosseum
+# formats datetime the way CR API does, so that it can be compared with API timestamps as a string
+def _format_cr_date(dt):
+    return dt.strftime('%Y%m%dT%H%M%S.000Z')
+
+
+# Per player gather war battles from the battlelog, and update clan level player stats
+# Only battles newer than `cursor` (timestamp of the latest battle saved during previous runs) are returned
+# for saving, older ones are parsed only if they are needed for the current war day stats
+# returns the list of war_battle records, see battlelog.WarBattle.get_record
+def populate_war_games(clan_tag, battles, war_start_time, player, cursor=None):
     # get the last timestamp (battles are newest first)
-    if len(battles) > 0:
-        b = battles[-1]
-        if war_start_time < b["battleTime"]:  # this should be the oldest game
-            player[player_tag].limited_info = True
-
-    for b in battles:
-        battle_type = b["type"]
-        # player might have been in a different clan during the war battle,
-        # need to check for that
-        if (battle_type == "riverRaceDuel"
-            or battle_type == "riverRaceDuelColosseum"
-            or battle_type == "riverRacePvP"
-            or battle_type == "boatBattle") \
-                and b["team"][0]["clan"]["tag"] == "#" + clan_tag:
-
-            if battle_type == "riverRaceDuel" or battle_type == "riverRaceDuelColosseum":
-                # we assume that the player that fewer towers at the end of the battle won the whole thing
-                player_towers = get_towers_count(b["team"][0])
-                opponent_towers = get_towers_count(b["opponent"][0])
-                game_count = len(b["team"][0]["cards"]) / 8
-
-                if war_start_time < b["battleTime"]:
-                    if player_towers > opponent_towers:  # won the duel
-                        player[player_tag].battles_won += game_count
-                    player[player_tag].battles_played += game_count
-
-                _save_battle(player[player_tag], b["battleTime"], game_count, player_towers > opponent_towers)
-            elif battle_type == "riverRacePvP":
-                defender_crown = b["team"][0]["crowns"] or 0
-                opponent_crown = b["opponent"][0]["crowns"] or 0
-                if war_start_time < b["battleTime"]:
-                    if defender_crown > opponent_crown:  # won the battle
-                        player[player_tag].battles_won += 1
-                    player[player_tag].battles_played += 1
-
-                _save_battle(player[player_tag], b["battleTime"], 1, defender_crown > opponent_crown)
-            else:  # boatBattle
-                if b["boatBattleSide"] != "defender":
-                    if war_start_time < b["battleTime"]:
-                        player[player_tag].battles_played += 1
-                        player[player_tag].boat_attacks += 1
-                    _save_battle(player[player_tag], b["battleTime"], 1, False)
+    if len(battles) > 0 and war_start_time < battles[-1]["battleTime"]:  # this should be the oldest game
+        player.limited_info = True
+
+    new_battles = []
+    since = None if cursor is None else min(cursor, war_start_time)
+    for battle in battlelog.parse_war_battles(battles, clan_tag, since):
+        if war_start_time < battle.battle_time:
+            player.battles_played += battle.decks_used
+            player.battles_won += battle.decks_won
+            if battle.is_boat_attack:
+                player.boat_attacks += 1
+        if cursor is None or cursor < battle.battle_time:
+            new_battles.append(battle.get_record())
+    return new_battles
 
 
 # Iterate through clan members, collect clan level stats, incomplete games, player stats
-def get_player_stats(ct, war_start_time, persistent_run):
+# Battlelog requests are run concurrently by FETCH_WORKERS threads, but the responses are processed
+# in clan members order, so stats and database writes don't depend on the order requests complete
+# In persistent run all the players and new battles are saved in one transaction after the data is loaded
+# With `scheduler` (polling.PollScheduler) set, only battlelogs of the players due for polling are loaded,
+# unless `poll_all` is set
+def get_player_stats(clan, war_start_time, persistent_run, executor, scheduler=None, poll_all=False):
     players = dict()
+    new_battles = []
+    new_cursors = {}
 
-    try:
-        for pt in cr.clan_member_tags(ct):
-            if pt not in players:
-                players[pt] = PlayerStats()
-                players[pt].name = cr.get_player_name(pt)
-                if persistent_run:
-                    players[pt].id = db.get_player_id(pt, players[pt].name)
-            populate_war_games(ct, pt, war_start_time, players)
-    except Exception as e:
-        err('Error loading player data, check API access and clan tag: ' + str(e))
+    members = list({m.tag: m for m in clan.members}.values())
+    cursors = {}
+    if persistent_run:
+        # only the cursors of the current members are loaded, not of every player ever saved
+        cursors = {tag: _format_cr_date(ts)
+                   for tag, ts in storage.get_battle_cursors([m.tag for m in members]).items()}
+    now = datetime.datetime.utcnow()
+    if scheduler is not None:
+        due_tags = scheduler.get_due([m.tag for m in members], now, poll_all)
+        log('%d of %d players are due for polling' % (len(due_tags), len(members)))
+    else:
+        due_tags = set(m.tag for m in members)
+    metrics.inc('players_polled', len(due_tags))
+    metrics.inc('players_skipped', len(members) - len(due_tags))
+    requests_in_flight = deque((m, executor.submit(cr.get_battlelog, m.tag) if m.tag in due_tags else None)
+                               for m in members)
+    lost_battles_players = 0
+    while requests_in_flight:
+        # completed futures keep the decoded battlelog, so they are dropped as soon as it is processed
+        member, future = requests_in_flight.popleft()
+        pt = member.tag
+        players[pt] = PlayerStats()
+        players[pt].name = member.name
+        if future is None:
+            continue
+        try:
+            battles = future.result()
+        except Exception as e:
+            err('Error loading battlelog of player %s, their battles are not counted: %s' % (pt, str(e)))
+            continue
+        if scheduler is not None and scheduler.observe(pt, [b["battleTime"] for b in battles], now):
+            lost_battles_players += 1
+        metrics.inc('battlelog_battles', len(battles))
+        try:
+            player_battles = populate_war_games(clan.tag, battles, war_start_time, players[pt], cursors.get(pt))
+        except Exception as e:
+            err('Error processing battlelog of player %s: %s' % (pt, str(e)))
+            continue
+        if players[pt].limited_info:
+            metrics.inc('limited_info_players')
+        new_battles.extend((pt,) + b for b in player_battles)
+        if battles:
+            new_cursors[pt] = battlelog.parse_cr_date(battles[0]["battleTime"])
+
+    if scheduler is not None:
+        scheduler.apply_budget(now)
+        if lost_battles_players:
+            log('%d players played more than the battlelog keeps since the previous poll' % lost_battles_players)
+
+    if persistent_run:
+        with metrics.timer('stage_seconds', stage='save'):
+            player_ids = storage.save_war_data((clan.tag, clan.name), [(pt, p.name) for pt, p in players.items()],
+                                               new_battles, new_cursors)
+        if player_ids:
+            for pt, player_id in player_ids.items():
+                players[pt].id = player_id
+            log('Players and %d new war battles saved' % len(new_battles))
     return players
 
 
 # Print clan's statistics for the war day (participant numbers, win ratio)
-def print_clan_war_day_stats(ct, player_stats):
+def print_clan_war_day_stats(clan_name, player_stats):
     cd = ClanData()
-    clan_name = cr.get_clan_name(ct)
     for key, value in player_stats.items():
         cd.battles_won += value.battles_won
         cd.battles_played += value.battles_played
@@ -179,7 +202,7 @@ def print_who_has_incomplete_games(player_stats):
             caveat_msg = "25+ games since war start"
         else:
             caveat_msg = ""
-        print("%s: %s %s" % (cr.get_player_name(key), int(value.battles_played), caveat_msg))
+        print("%s: %s %s" % (value.name, value.battles_played, caveat_msg))
 
 
 # returns the cutout date for the report
@@ -192,8 +215,47 @@ def get_first_report_date():
         return (dt - datetime.timedelta(days=dt.weekday() + 1)).strftime("%Y-%m-%d")
 
 
+# returns the first day of the current season: seasons start on the first Monday of the month
+def get_season_start_date():
+    today = datetime.datetime.utcnow().date()
+    first_monday = today.replace(day=1 + (7 - today.replace(day=1).weekday()) % 7)
+    if first_monday > today:
+        previous_month = today.replace(day=1) - datetime.timedelta(days=1)
+        first_monday = previous_month.replace(day=1 + (7 - previous_month.replace(day=1).weekday()) % 7)
+    return first_monday.strftime("%Y-%m-%d")
+
+
+# returns [(sheet name, cutout date)] for REPORT_WINDOWS
+def get_report_windows():
+    res = []
+    for window in REPORT_WINDOWS:
+        if window == 'week':
+            res.append((spreadsheet.EXPORT_RANGE_NAME, get_first_report_date()))
+        elif window == 'season':
+            res.append(('Season', get_season_start_date()))
+        elif window[:-1].isdigit() and int(window[:-1]) > 0 and window.endswith('w'):
+            cutout_date = datetime.datetime.strptime(get_first_report_date(), "%Y-%m-%d") \
+                - datetime.timedelta(weeks=int(window[:-1]) - 1)
+            res.append(('Last ' + window, cutout_date.strftime("%Y-%m-%d")))
+        else:
+            err('Unknown report window ' + window)
+    return res
+
+
+def _export(out, range_name):
+    if REPORT_DEBUG:
+        print(out)
+        return
+    try:
+        with metrics.timer('stage_seconds', stage='export'):
+            cells = spreadsheet.export_to_sheet(out, range_name)
+        log('Report exported to %s, %d cells updated' % (range_name, cells))
+    except Exception as e:
+        err('Cannot export report: ' + str(e))
+
+
 # returns a text for posting on Discord
-def get_notification_message():
+def get_notification_message(clan_tag):
     def get_player_mention(discord_id, name, is_in_clan, is_mini):
         res = ''
         if discord_id is not None:
@@ -212,10 +274,9 @@ Stats as of %s (%d hours before the war day end):
 %s
     """.strip()
     now = datetime.datetime.utcnow()
-    war_day = _get_war_day(now, False)
     war_day_formatted = _get_war_day(now)
-    day_stats = db.get_war_day_stats(war_day_formatted)
-    player_stats = db.get_war_day_player_stats(war_day_formatted)
+    day_stats = storage.get_war_day_stats(clan_tag, war_day_formatted)
+    player_stats = storage.get_war_day_player_stats(clan_tag, war_day_formatted)
     if not day_stats:
         return None
 
@@ -239,8 +300,7 @@ Stats as of %s (%d hours before the war day end):
     else:
         players_report = '*Everybody played their battles. Great job!*'
     return message_template % (now.strftime('%H:%M:%S'),
-                               round((datetime.datetime.combine(war_day + datetime.timedelta(days=1),
-                                                                datetime.time(10, 0)) - now).seconds / 3600),
+                               round((get_war_day_end(now) - now).seconds / 3600),
                                day_stats[0][0] or 0,
                                day_stats[0][1] or 0,
                                participation_rate,
@@ -249,94 +309,151 @@ Stats as of %s (%d hours before the war day end):
                                )
 
 
-def send_discord_message(url, message, report_url):
-    requests.post(url,
-                  headers={"Accept": "application/json", "Content-Type": "application/json", },
-                  json={"content": message,
-                        "embeds": [{
-                            "title": "Full report",
-                            "url": report_url
-                        }]
-                        })
-
-
-def report(notify: bool):
-    start_time = _get_war_start_prefix()
-
-    if len(sys.argv) >= 2 and sys.argv[1] and not sys.argv[1].startswith('--'):
-        log('Running check for clan with tag ' + sys.argv[1])
-        clan_tag = sys.argv[1]
-        persistent_run = False
+# returns tags of the clans tracked in persistent run: CLAN_TAG is the main clan, its report is exported to the
+# main sheet and posted to Discord; CLAN_TAGS optionally lists other clans (e.g. the clan family) which are saved
+# and exported to their own sheets too
+def get_tracked_clan_tags():
+    main_clan_tag = config('CLAN_TAG')
+    return list(dict.fromkeys([main_clan_tag] + config('CLAN_TAGS', default='', cast=Csv())))
+
+
+# applies Players sheet mapping (player tag, discord id, is mini account) to the database in one transaction,
+# players missing in the mapping lose their ids
+def update_notification_ids():
+    mapping = {}
+    for record in spreadsheet.get_notifications_mapping():
+        if len(record) > 1 and record[0] and record[1]:
+            mapping[record[0].upper()] = (record[1], bool(record[2]) if len(record) > 2 else False)
+
+    updated = storage.sync_notification_ids(mapping)
+    if updated:
+        log('Notification ids updated for %d players' % updated)
+
+
+# updates players notification ids and posts the clan war day stats to Discord if `notify` is set
+def send_notification(clan_tag, notify):
+    if config('DISCORD_WEBHOOK') and notify:
+        try:
+            update_notification_ids()
+        except Exception as e:
+            err('Cannot update player mapping: ' + str(e))
+
+        try:
+            message = get_notification_message(clan_tag)
+            if message is None:
+                log('No war day stats, skipping notification')
+                return
+            log('Queueing notification')
+            # the first line has the current time, the rest is compared to skip repeated notifications
+            notifier.send(config('DISCORD_WEBHOOK'), message,
+                          'https://docs.google.com/spreadsheets/d/' + config('SPREADSHEET_ID'),
+                          message.split('\n', 1)[-1])
+        except Exception as e:
+            err('Cannot send notification message: ' + str(e))
     else:
-        clan_tag = config('CLAN_TAG')
-        log(f'Updating database and exporting default clan with tag {clan_tag}')
-        persistent_run = True
+        if config('DISCORD_WEBHOOK'):
+            log('Notification is not scheduled this time')
+        else:
+            log('No webhook url, skipping notification')
 
+
+def report_clan(clan_tag, start_time, persistent_run, is_main_clan, notify, executor, scheduler=None, poll_all=False):
     players = None
+    clan = None
     if not REPORT_DEBUG:
-        players = get_player_stats(clan_tag, start_time, persistent_run)
+        try:
+            with metrics.timer('stage_seconds', stage='clan'):
+                clan = cr.get_clan(clan_tag)
+        except Exception as e:
+            err('Error loading clan %s data, check API access and clan tag: %s' % (clan_tag, str(e)))
+            return
+        with metrics.timer('stage_seconds', stage='players'):
+            players = get_player_stats(clan, start_time, persistent_run, executor, scheduler, poll_all)
         if players:
-            log('Stats loaded, %d players found' % len(players))
+            log('Stats loaded for clan %s, %d players found' % (clan_tag, len(players)))
         else:
             return
 
         if persistent_run:
-            db.mark_leavers([players[p].id for p in players if players[p].id is not None])
+            with metrics.timer('stage_seconds', stage='mark_leavers'):
+                storage.mark_leavers(clan_tag, [players[p].id for p in players if players[p].id is not None])
             log('Marked players no longer in clan')
     else:
         log('Report debug mode is ON')
 
     if persistent_run:
-        cutout_date = get_first_report_date()
-        log('Report cutout date: ' + cutout_date)
-        out = db.get_report(cutout_date)
+        # sheets of other clans are suffixed with the clan tag
+        sheet_suffix = '' if is_main_clan else ' ' + clan_tag
+        out = None
+        for sheet_name, cutout_date in get_report_windows():
+            log('Report %s cutout date: %s' % (sheet_name, cutout_date))
+            with metrics.timer('stage_seconds', stage='report'):
+                out = storage.get_report(clan_tag, cutout_date)
+            if out is None:
+                break
+            _export(out, sheet_name + sheet_suffix)
+        if out is not None and SEASON_SUMMARY:
+            with metrics.timer('stage_seconds', stage='season_summary'):
+                summary = storage.get_season_summary(clan_tag, get_season_start_date())
+            if summary is not None:
+                _export(summary, 'Season Summary' + sheet_suffix)
+
         if out is not None:
-            if not REPORT_DEBUG:
-                try:
-                    spreadsheet.export_to_sheet(out)
-                    log('Report exported')
-                except Exception as e:
-                    err('Cannot export report: ' + str(e))
-            else:
-                print(out)
-
-            if config('DISCORD_WEBHOOK') and (notify or datetime.datetime.utcnow().time().hour in REPORT_HOURS):
-                log('Updating players notification ids')
-                db.reset_notification_ids()
-                try:
-                    mapping = spreadsheet.get_notifications_mapping()
-                    if mapping:
-                        for record in mapping:
-                            if len(record) > 1 and record[0] and record[1]:
-                                db.set_player_notification_id(record[0].upper(), record[1],
-                                                              bool(record[2]) if len(record) > 2 else False)
-                except Exception as e:
-                    err('Cannot update player mapping: ' + str(e))
-
-                log('Sending notification')
-                try:
-                    send_discord_message(config('DISCORD_WEBHOOK'), get_notification_message(),
-                                         'https://docs.google.com/spreadsheets/d/' + config('SPREADSHEET_ID'))
-                except Exception as e:
-                    err('Cannot send notification message: ' + str(e))
-            else:
-                if config('DISCORD_WEBHOOK'):
-                    log('Notification is not scheduled this time')
-                else:
-                    log('No webhook url, skipping notification')
+            if is_main_clan:
+                with metrics.timer('stage_seconds', stage='notification'):
+                    send_notification(clan_tag, notify)
 
         else:
             log('Report is empty, possibly no database')
             if players is not None:
                 print_who_has_incomplete_games(players)
-                print_clan_war_day_stats(clan_tag, players)
+                print_clan_war_day_stats(clan.name, players)
     else:
         if players is not None:
             print_who_has_incomplete_games(players)
-            print_clan_war_day_stats(clan_tag, players)
+            print_clan_war_day_stats(clan.name, players)
 
+
+# loads and reports data of the clans, the first one is the main clan; used by both one-shot and daemon runs,
+# see get_player_stats for `scheduler` and `poll_all`
+def run_report(clan_tags, persistent_run, notify, scheduler=None, poll_all=False):
+    start_time = _get_war_start_prefix()
+    stage_totals = metrics.get_totals()
+
+    # all the clans share the workers and the rate limited API client
+    with metrics.timer('stage_seconds', stage='run'), ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        for clan_tag in clan_tags:
+            # a failing clan doesn't stop the others
+            try:
+                report_clan(clan_tag, start_time, persistent_run, clan_tag == clan_tags[0], notify, executor,
+                            scheduler, poll_all)
+            except Exception as e:
+                err('Error reporting clan %s: %s' % (clan_tag, str(e)))
+    metrics.inc('runs')
+
+    log('CR API requests: ' + (cr.client.get_stats_summary() or 'none'))
+    log('Stage timings: ' + metrics.get_summary(stage_totals))
+    if metrics.METRICS_FILE:
+        try:
+            metrics.dump()
+        except OSError as e:
+            err('Cannot save metrics: ' + str(e))
     log('Run finished')
 
 
+def report(notify: bool):
+    manual_clan_tags = [a for a in sys.argv[1:] if a and not a.startswith('--')]
+    if manual_clan_tags:
+        log('Running check for clans with tags ' + ', '.join(manual_clan_tags))
+        run_report(manual_clan_tags, False, False)
+    else:
+        clan_tags = get_tracked_clan_tags()
+        log('Updating database and exporting clans with tags ' + ', '.join(clan_tags))
+        run_report(clan_tags, True, notify or datetime.datetime.utcnow().time().hour in REPORT_HOURS)
+        # notifications are sent in background, the process shouldn't exit before that
+        if not notifier.flush(NOTIFICATION_FLUSH_TIMEOUT):
+            err('Notification is not sent in %d seconds' % NOTIFICATION_FLUSH_TIMEOUT)
+
+
 if __name__ == '__main__':
     report('--notify' in sys.argv)
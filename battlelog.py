@@ -0,0 +1,102 @@
+# Battlelog parsing: picks clan war battles out of the CR API battlelog response
+# Has no API or database dependencies, so it can be run on recorded responses
+import datetime
+
+# how the result of a war battle is determined
+DUEL = 0
+PVP = 1
+BOAT = 2
+
+# Battle types are: (NOT complete, there may be many others)
+# boatBattle
+# casual1v1
+# casual2v2
+# challenge
+# clanMate
+# clanMate2v2
+# friendly
+# None
+# PvP
+# riverRaceDuel
+# riverRacePvP
+# riverRaceDuelColosseum
+# only the ones listed here are war battles
+WAR_BATTLE_TYPES = {
+    "riverRaceDuel": DUEL,
+    "riverRaceDuelColosseum": DUEL,
+    "riverRacePvP": PVP,
+    "boatBattle": BOAT,
+}
+
+# war day date (YYYY-MM-DD) by battle date (YYYYMMDD) and whether the battle is before 10:00
+_war_days = {}
+
+
+# parses fixed width CR API timestamp, e.g. 20210415T101530.000Z
+def parse_cr_date(s):
+    return datetime.datetime(int(s[0:4]), int(s[4:6]), int(s[6:8]), int(s[9:11]), int(s[11:13]), int(s[13:15]),
+                             int(s[16:19]) * 1000)
+
+
+# returns war day of CR API timestamp as YYYY-MM-DD, battles before 10:00 belong to the previous day
+def get_war_day(s):
+    key = (s[:8], s[9:11] < "10")
+    war_day = _war_days.get(key)
+    if war_day is None:
+        day = datetime.date(int(s[0:4]), int(s[4:6]), int(s[6:8]))
+        if key[1]:
+            day -= datetime.timedelta(days=1)
+        war_day = _war_days[key] = day.strftime("%Y-%m-%d")
+    return war_day
+
+
+class WarBattle:
+    __slots__ = ("battle_time", "decks_used", "decks_won", "is_boat_attack")
+
+    def __init__(self, battle_time, decks_used, decks_won, is_boat_attack=False):
+        # CR API timestamp, can be compared with other timestamps as a string
+        self.battle_time = battle_time
+        self.decks_used = decks_used
+        self.decks_won = decks_won
+        self.is_boat_attack = is_boat_attack
+
+    # returns war_battle record values: (timestamp, war_day, decks_used, decks_won, fame, is_boat_attack)
+    def get_record(self):
+        return (parse_cr_date(self.battle_time), get_war_day(self.battle_time), self.decks_used, self.decks_won, 0,
+                self.is_boat_attack)
+
+
+def _get_towers_count(t):
+    return (1 if t.get("kingTowerHitPoints") else 0) + len(t.get("princessTowersHitPoints") or ())
+
+
+# returns WarBattle list of the war battles played for clan `clan_tag` (without #) in `battles` (newest first),
+# boat battles are returned only when the player attacked; with `since` set, stops at the first battle
+# played not after it
+def parse_war_battles(battles, clan_tag, since=None):
+    clan_tag = "#" + clan_tag
+    res = []
+    for b in battles:
+        battle_time = b["battleTime"]
+        if since is not None and battle_time <= since:
+            break
+        kind = WAR_BATTLE_TYPES.get(b["type"])
+        if kind is None:
+            continue
+        team = b["team"][0]
+        # player might have been in a different clan during the war battle
+        if team.get("clan", {}).get("tag") != clan_tag:
+            continue
+
+        if kind == DUEL:
+            # we assume that the player that fewer towers at the end of the battle won the whole thing
+            opponent = b["opponent"][0]
+            games = len(team["cards"]) // 8
+            won = _get_towers_count(team) > _get_towers_count(opponent)
+            res.append(WarBattle(battle_time, games, games if won else 0))
+        elif kind == PVP:
+            won = (team["crowns"] or 0) > (b["opponent"][0]["crowns"] or 0)
+            res.append(WarBattle(battle_time, 1, 1 if won else 0))
+        elif b.get("boatBattleSide") != "defender":
+            res.append(WarBattle(battle_time, 1, 0, True))
+    return res
@@ -0,0 +1,79 @@
+# Synthetic CR API responses for offline runs and benchmarks, written in the format used by
+# crlib.ApiClient record/replay mode (see CR_API_REPLAY_DIR)
+import datetime
+import json
+import os
+import random
+
+# all the battle types the report code distinguishes plus some of the ones it skips
+BATTLE_TYPES = ['riverRacePvP', 'riverRaceDuel', 'riverRaceDuelColosseum', 'boatBattle', 'PvP', 'casual1v1',
+                'clanMate', 'challenge']
+BATTLELOG_SIZE = 25
+
+
+def _format_cr_date(dt):
+    return dt.strftime('%Y%m%dT%H%M%S.000Z')
+
+
+def _get_team(rnd, clan_tag, cards, towers):
+    return {
+        'tag': '#P' + str(rnd.randint(100000, 999999)),
+        'clan': {'tag': '#' + clan_tag},
+        'crowns': 3 - towers,
+        'kingTowerHitPoints': rnd.randint(1, 5000) if towers == 3 else None,
+        'princessTowersHitPoints': [rnd.randint(1, 3000) for _ in range(min(towers, 2))],
+        'cards': [{'name': 'card %d' % i, 'level': 11} for i in range(cards)],
+    }
+
+
+def get_battle(rnd, clan_tag, battle_time):
+    battle_type = rnd.choice(BATTLE_TYPES)
+    cards = 8 * rnd.randint(2, 3) if battle_type.startswith('riverRaceDuel') else 8
+    return {
+        'type': battle_type,
+        'battleTime': _format_cr_date(battle_time),
+        'boatBattleSide': rnd.choice(['attacker', 'defender']) if battle_type == 'boatBattle' else None,
+        'team': [_get_team(rnd, clan_tag, cards, rnd.randint(0, 3))],
+        'opponent': [_get_team(rnd, 'OPPONENT', cards, rnd.randint(0, 3))],
+    }
+
+
+# returns battlelog of BATTLELOG_SIZE battles, newest first, spread over `hours` before `now`
+def get_battlelog(rnd, clan_tag, now, hours=36):
+    times = sorted((now - datetime.timedelta(seconds=rnd.randint(0, hours * 3600)) for _ in range(BATTLELOG_SIZE)),
+                   reverse=True)
+    return [get_battle(rnd, clan_tag, t) for t in times]
+
+
+def get_clan(rnd, clan_tag, members):
+    return {
+        'tag': '#' + clan_tag,
+        'name': 'Clan ' + clan_tag,
+        'memberList': [{
+            'tag': '#%s%02d' % (clan_tag, i),
+            'name': 'player %d of %s' % (i, clan_tag),
+            'role': 'member' if i else 'leader',
+            'expLevel': rnd.randint(30, 60),
+            'trophies': rnd.randint(4000, 8000),
+            'lastSeen': _format_cr_date(datetime.datetime.utcnow()),
+        } for i in range(members)],
+    }
+
+
+def _write(directory, path, data):
+    file_name = os.path.join(directory, *path.split('/')) + '.json'
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w') as f:
+        json.dump(data, f)
+
+
+# writes responses for the clan and battlelogs of its members; returns the list of member tags
+def generate_clan(directory, clan_tag, members=50, seed=0, now=None):
+    rnd = random.Random('%s-%d' % (clan_tag, seed))
+    now = now or datetime.datetime.utcnow()
+    clan = get_clan(rnd, clan_tag, members)
+    _write(directory, 'clans/' + clan_tag, clan)
+    tags = [m['tag'][1:] for m in clan['memberList']]
+    for tag in tags:
+        _write(directory, 'players/%s/battlelog' % tag, get_battlelog(rnd, clan_tag, now))
+    return tags
@@ -0,0 +1,58 @@
+# Cold start benchmark: measures how long importing the entry point modules takes with `python -X importtime`
+# in a fresh interpreter, lists the slowest imported packages and checks that the modules only needed for
+# the database, Sheets export or reports are not imported on startup
+# Exits with non-zero status if the import takes longer than --budget ms (median of --runs) or a heavy module is
+# imported, so it can be used as a check for cron and bot use where every run is a cold start
+# Usage: python benchmarks/import_time.py [--module <name>] [--runs <number>] [--budget <ms>]
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules loaded only when they are used
+LAZY_MODULES = ['psycopg2', 'numpy', 'googleapiclient', 'google.oauth2']
+TOP_IMPORTS = 10
+
+
+# returns ({module: cumulative import time in us} for the top level imports, lazy modules imported)
+def measure(module):
+    code = 'import sys, %s; print(",".join(m for m in %r if m in sys.modules))' % (module, LAZY_MODULES)
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True,
+                         check=True)
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented by two spaces per level, only direct imports of the module are kept
+        if len(name) - len(name.lstrip()) <= 3:
+            times[name.strip()] = int(cumulative)
+    return times, [m for m in res.stdout.strip().split(',') if m]
+
+
+def run(module, runs, budget):
+    results = [measure(module) for _ in range(runs)]
+    total = statistics.median(times[module] for times, _ in results) / 1000
+    times, lazy_imported = results[-1]
+
+    print('import %s: median %.1f ms of %d runs' % (module, total, runs))
+    print('slowest imports of the last run, ms:')
+    for name, t in sorted(times.items(), key=lambda item: -item[1])[:TOP_IMPORTS]:
+        print('  %-32s %8.1f' % (name, t / 1000))
+    failed = False
+    if lazy_imported:
+        print('modules expected to be imported lazily: ' + ', '.join(lazy_imported))
+        failed = True
+    if budget and total > budget:
+        print('import takes longer than %d ms budget' % budget)
+        failed = True
+    return not failed
+
+
+if __name__ == '__main__':
+    def get_arg(name, default):
+        return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+    if not run(get_arg('--module', 'CW2DayAnalysis'), int(get_arg('--runs', 5)), int(get_arg('--budget', 0))):
+        sys.exit(1)
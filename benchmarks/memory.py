@@ -0,0 +1,84 @@
+# Memory benchmark of daemon mode: reports for many clans are run repeatedly the way daemon.py does, with CR API
+# responses replayed from synthetic fixtures (see fixtures.py) and without the database, Sheets and Discord.
+# Prints process RSS and Python heap retained between runs per tracked player, and the peak heap during a run.
+# Usage: python benchmarks/memory.py [--clans <number>] [--members <number>] [--runs <number>]
+import contextlib
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+
+CLAN_TAG = 'BENCH'
+
+
+# returns resident set size in MB, from /proc on Linux, peak RSS elsewhere
+def get_rss():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+# the stats are printed in manual mode, they are not needed here
+def _run_report(analysis, clan_tags, scheduler):
+    with contextlib.redirect_stdout(io.StringIO()):
+        analysis.run_report(clan_tags, False, False, scheduler, True)
+
+
+def run(clans, members, runs):
+    fixtures_dir = tempfile.mkdtemp(prefix='cr_fixtures_')
+    clan_tags = [CLAN_TAG + str(i) for i in range(clans)]
+    for clan_tag in clan_tags:
+        fixtures.generate_clan(fixtures_dir, clan_tag, members)
+
+    # settings are read on import, so the project modules are imported after environment is prepared
+    os.environ['CR_API_REPLAY_DIR'] = fixtures_dir
+    os.environ['CLAN_TAG'] = clan_tags[0]
+    os.environ['DISCORD_WEBHOOK'] = ''
+    import CW2DayAnalysis
+    import polling
+    import utils
+
+    utils.logger.setLevel(logging.WARNING)
+    players = clans * members
+    try:
+        rss_before = get_rss()
+        rss = []
+        scheduler = polling.PollScheduler()
+        for _ in range(runs):
+            _run_report(CW2DayAnalysis, clan_tags, scheduler)
+            rss.append(get_rss())
+        # heap is traced in a separate run from scratch as tracing itself takes a lot of memory
+        tracemalloc.start()
+        heap_before = tracemalloc.get_traced_memory()[0]
+        _run_report(CW2DayAnalysis, clan_tags, polling.PollScheduler())
+        heap_after, heap_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(fixtures_dir)
+
+    print('%d clans of %d members, %d runs' % (clans, members, runs))
+    print('RSS: %.1f MB before the runs, %s MB after every run' % (rss_before, ', '.join('%.1f' % r for r in rss)))
+    print('RSS growth per tracked player: %.2f KB' % ((rss[-1] - rss_before) * 1024 / players))
+    print('Python heap retained per tracked player: %.2f KB, peak during a run per player: %.2f KB' %
+          ((heap_after - heap_before) / 1024 / players, (heap_peak - heap_before) / 1024 / players))
+    print('PlayerStats instance: %d bytes' % sys.getsizeof(CW2DayAnalysis.PlayerStats()))
+
+
+if __name__ == '__main__':
+    def get_arg(name, default):
+        return int(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+    run(get_arg('--clans', 20), get_arg('--members', 50), get_arg('--runs', 5))
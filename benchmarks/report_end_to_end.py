@@ -0,0 +1,83 @@
+# End to end benchmark of report() for one or more clans: CR API responses are replayed from synthetic fixtures
+# (see fixtures.py),
+# the data is saved to the database configured in .env in a separate schema which is dropped afterwards.
+# Sheets export is skipped, Discord notification is disabled.
+# The first run saves all the battles, the following ones only find nothing new.
+# Usage: python benchmarks/report_end_to_end.py [--clans <number>] [--members <number>] [--runs <number>]
+#   [--latency <ms>]
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+
+SCHEMA = 'benchmark'
+CLAN_TAG = 'BENCH'
+
+
+def run(clans, members, runs, latency):
+    fixtures_dir = tempfile.mkdtemp(prefix='cr_fixtures_')
+    clan_tags = [CLAN_TAG + str(i) for i in range(clans)]
+    for clan_tag in clan_tags:
+        fixtures.generate_clan(fixtures_dir, clan_tag, members)
+
+    # settings are read on import, so the project modules are imported after environment is prepared
+    os.environ['CR_API_REPLAY_DIR'] = fixtures_dir
+    os.environ['CR_API_REPLAY_LATENCY'] = str(latency)
+    os.environ['CLAN_TAG'] = clan_tags[0]
+    os.environ['CLAN_TAGS'] = ','.join(clan_tags)
+    os.environ['DISCORD_WEBHOOK'] = ''
+    os.environ['PGOPTIONS'] = '-c search_path=' + SCHEMA
+    import CW2DayAnalysis
+    import crlib
+    import db
+    import migrate
+    import utils
+
+    utils.logger.setLevel(logging.WARNING)
+    # export_to_sheet returns the number of cells updated
+    CW2DayAnalysis.spreadsheet.export_to_sheet = lambda *args: 0
+    sys.argv = sys.argv[:1]
+
+    with db.connection() as conn:
+        if conn is None:
+            sys.exit('Database is not available')
+        with conn.cursor() as cur:
+            cur.execute('DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s;' % (SCHEMA, SCHEMA))
+        conn.commit()
+    try:
+        if migrate.migrate() is None:
+            sys.exit('Cannot create database schema')
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            CW2DayAnalysis.report(False)
+            times.append((time.perf_counter() - start) * 1000)
+    finally:
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT count(*) FROM war_battle;')
+                war_battles = cur.fetchone()[0]
+                cur.execute('DROP SCHEMA IF EXISTS %s CASCADE;' % SCHEMA)
+            conn.commit()
+        shutil.rmtree(fixtures_dir)
+
+    print('%d clans of %d members, %d war battles saved, API latency %s ms' % (clans, members, war_battles, latency))
+    print('CR API requests: ' + crlib.client.get_stats_summary())
+    print('first run: %.1f ms' % times[0])
+    if len(times) > 1:
+        print('next runs: median %.1f ms, min %.1f ms, max %.1f ms' %
+              (statistics.median(times[1:]), min(times[1:]), max(times[1:])))
+
+
+if __name__ == '__main__':
+    def get_arg(name, default):
+        return float(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+    run(int(get_arg('--clans', 1)), int(get_arg('--members', 50)), int(get_arg('--runs', 5)), get_arg('--latency', 0))
@@ -0,0 +1,144 @@
+# Benchmark of the report queries on a synthetic multi-season dataset:
+# - aggregating raw war_battle rows without indexes
+# - the same after the war_battle indexes migration
+# - the current queries reading player_war_day totals (all the migrations applied)
+# Runs against the database configured in .env; all the data is created in a separate schema which is dropped
+# afterwards
+# Usage: python benchmarks/report_queries.py [--seasons <number>] [--index-migration <number>]
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import migrate
+
+SCHEMA = 'benchmark'
+CLAN_TAG = 'BENCH'
+# players who have ever been in clan, 50 of them are current members
+PLAYERS = 200
+DAYS_IN_SEASON = 35
+REPEATS = 20
+
+QUERY_CREATE_PLAYERS = """
+    INSERT INTO player (tag, name, is_in_clan)
+    SELECT 'P' || i, 'player ' || i, i > %(players)s - 50
+    FROM generate_series(1, %(players)s) i;
+"""
+# every day ~50 players make 4 attacks, membership slowly rotates over the seasons
+QUERY_CREATE_BATTLES = """
+    INSERT INTO war_battle (player_id, battle_timestamp, war_day, decks_used, decks_won, fame)
+    SELECT p.id, d + interval '10 hours' + b * interval '1 hour' + p.id * interval '1 second', d, 1,
+        (random() < 0.5)::int, 0
+    FROM generate_series(current_date - %(days)s, current_date, interval '1 day') d
+    CROSS JOIN generate_series(0, 3) b
+    JOIN player p ON p.id BETWEEN (current_date - d::date) * %(players)s / (%(days)s + 1) / 3 + 1
+        AND (current_date - d::date) * %(players)s / (%(days)s + 1) / 3 + 50;
+"""
+
+# report queries aggregating raw battles, as they were before player_war_day table was introduced
+RAW_QUERY_GET_LAST_WEEK_STATS = """
+    SELECT wb.war_day, SUM(wb.decks_used) as played, SUM(wb.decks_won) as won, p.id as player_id, p.name,
+        p.is_in_clan
+    FROM player p
+    LEFT JOIN war_battle wb ON wb.player_id = p.id AND wb.war_day >= %(day)s
+    WHERE p.is_in_clan OR wb.id is not NULL
+    GROUP BY p.id, wb.war_day
+    ORDER BY p.is_in_clan DESC, p.id, wb.war_day
+"""
+RAW_QUERY_GET_WAR_DAY_STATS = """
+    SELECT count(players) as players, sum(played) as played, sum(won) as won
+    FROM (
+        SELECT count(*) as players, sum(decks_used) as played, sum(decks_won) as won
+        FROM war_battle
+        WHERE war_day = %(day)s
+        GROUP BY player_id
+    ) as p
+"""
+RAW_QUERY_GET_WAR_DAY_PLAYER_STATS = """
+    SELECT p.name, p.discord_id, p.is_in_clan, p.is_mini, SUM(COALESCE(wb.decks_used, 0)) as used
+    FROM player p
+    LEFT JOIN war_battle wb ON wb.player_id = p.id AND wb.war_day = %(day)s
+    WHERE p.is_in_clan OR wb.decks_used is NOT NULL
+    GROUP BY p.id
+    HAVING SUM(COALESCE(wb.decks_used, 0)) < 4
+    ORDER BY 5;
+"""
+QUERY_NAMES = ['last week stats', 'war day stats', 'war day player stats']
+
+
+# returns list of (name, query, parameters)
+def get_queries(last_week_query, war_day_query, war_day_player_query):
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    week_ago = time.strftime('%Y-%m-%d', time.gmtime(time.time() - 7 * 24 * 3600))
+    return list(zip(QUERY_NAMES, [last_week_query, war_day_query, war_day_player_query],
+                    [{'clan': CLAN_TAG, 'day': week_ago}, {'clan': CLAN_TAG, 'day': today},
+                     {'clan': CLAN_TAG, 'day': today}]))
+
+
+def apply_migrations(cur, condition):
+    for version, path in migrate.get_migrations():
+        if condition(version):
+            with open(path, 'r') as f:
+                cur.execute(f.read())
+
+
+# returns {query name: median time in ms}
+def measure(cur, queries):
+    res = {}
+    for name, query, params in queries:
+        times = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            cur.execute(query, params)
+            cur.fetchall()
+            times.append((time.perf_counter() - start) * 1000)
+        res[name] = statistics.median(times)
+    return res
+
+
+def run(seasons, index_migration):
+    days = seasons * DAYS_IN_SEASON
+    with db.connection() as conn:
+        if conn is None:
+            sys.exit('Database is not available')
+        cur = conn.cursor()
+        try:
+            cur.execute('DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s; SET search_path TO %s;'
+                        % (SCHEMA, SCHEMA, SCHEMA))
+            cur.execute(migrate.QUERY_SET_SETTING, ('crwar.clan_tag', CLAN_TAG))
+            apply_migrations(cur, lambda v: v < index_migration)
+            cur.execute(QUERY_CREATE_PLAYERS, {'players': PLAYERS})
+            cur.execute(QUERY_CREATE_BATTLES, {'players': PLAYERS, 'days': days})
+            cur.execute('ANALYZE;')
+            cur.execute('SELECT count(*) FROM war_battle;')
+            print('%d seasons, %d war battles' % (seasons, cur.fetchone()[0]))
+
+            raw_queries = get_queries(RAW_QUERY_GET_LAST_WEEK_STATS, RAW_QUERY_GET_WAR_DAY_STATS,
+                                      RAW_QUERY_GET_WAR_DAY_PLAYER_STATS)
+            raw = measure(cur, raw_queries)
+            apply_migrations(cur, lambda v: v == index_migration)
+            cur.execute('ANALYZE;')
+            indexed = measure(cur, raw_queries)
+            apply_migrations(cur, lambda v: v > index_migration)
+            cur.execute('ANALYZE;')
+            current = measure(cur, get_queries(db.QUERY_GET_LAST_WEEK_STATS, db.QUERY_GET_WAR_DAY_STATS,
+                                               db.QUERY_GET_WAR_DAY_PLAYER_STATS))
+
+            print('%-24s %12s %12s %12s' % ('query, median ms', 'raw', 'indexed', 'current'))
+            for name in QUERY_NAMES:
+                print('%-24s %12.2f %12.2f %12.2f' % (name, raw[name], indexed[name], current[name]))
+        finally:
+            conn.rollback()
+            cur.execute('DROP SCHEMA IF EXISTS %s CASCADE;' % SCHEMA)
+            conn.commit()
+            cur.close()
+
+
+if __name__ == '__main__':
+    def get_arg(name, default):
+        return int(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+    run(get_arg('--seasons', 12), get_arg('--index-migration', 3))
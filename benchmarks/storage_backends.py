@@ -0,0 +1,138 @@
+# Benchmark of the storage backends (see storage.py) on the same synthetic data: ingest of war battles through
+# save_war_data, the way every run saves them, and latency of the report queries
+# Postgres is the database configured in .env, the data is created in a separate schema which is dropped
+# afterwards; SQLite uses a temporary file
+# Usage: python benchmarks/storage_backends.py [--clans <number>] [--members <number>] [--days <number>]
+#   [--backends postgres,sqlite]
+import datetime
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCHEMA = 'benchmark'
+CLAN_TAG = 'BENCH'
+REPEATS = 10
+
+
+# returns save_war_data arguments for one poll of the clan per day: every member plays 4 battles a day
+def generate_polls(clan_tag, members, days, seed=0):
+    rnd = random.Random(seed)
+    players = [(clan_tag + 'P' + str(i), 'player %d of %s' % (i, clan_tag)) for i in range(members)]
+    today = datetime.datetime.utcnow().date()
+    res = []
+    for d in range(days):
+        war_day = today - datetime.timedelta(days=days - 1 - d)
+        start = datetime.datetime.combine(war_day, datetime.time(10))
+        battles = [(tag, start + datetime.timedelta(hours=b, seconds=i), war_day.strftime('%Y-%m-%d'), 1,
+                    int(rnd.random() < 0.5), 0, False)
+                   for i, (tag, _) in enumerate(players) for b in range(4)]
+        cursors = {tag: start + datetime.timedelta(hours=3, seconds=i) for i, (tag, _) in enumerate(players)}
+        res.append(((clan_tag, clan_tag), players, battles, cursors))
+    return res
+
+
+def measure(call):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        call()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+# returns {measurement name: ms}
+def run_backend(backend, clan_tags, polls):
+    import storage
+
+    res = {}
+    times = []
+    for day_polls in zip(*polls):
+        for args in day_polls:
+            start = time.perf_counter()
+            if backend.save_war_data(*args) is None:
+                sys.exit('Cannot save war data')
+            times.append((time.perf_counter() - start) * 1000)
+    res['ingest, total'] = sum(times)
+    res['ingest per poll'] = statistics.median(times)
+
+    storage.backend = backend
+    today = datetime.datetime.utcnow().date()
+    week_ago = (today - datetime.timedelta(days=7)).strftime('%Y-%m-%d')
+    season_start = (today - datetime.timedelta(days=35)).strftime('%Y-%m-%d')
+    clan_tag = clan_tags[0]
+    res['week report'] = measure(lambda: storage.get_report(clan_tag, week_ago))
+    res['season report'] = measure(lambda: storage.get_report(clan_tag, season_start))
+    res['season summary'] = measure(lambda: storage.get_season_summary(clan_tag, season_start))
+    res['war day stats'] = measure(lambda: storage.get_war_day_stats(clan_tag, today.strftime('%Y-%m-%d')))
+    res['war day player stats'] = measure(
+        lambda: storage.get_war_day_player_stats(clan_tag, today.strftime('%Y-%m-%d')))
+    return res
+
+
+def run_postgres(clan_tags, polls):
+    import db
+    import migrate
+
+    with db.connection() as conn:
+        if conn is None:
+            print('Postgres is not available, skipped')
+            return None
+        with conn.cursor() as cur:
+            cur.execute('DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s;' % (SCHEMA, SCHEMA))
+        conn.commit()
+    try:
+        if migrate.migrate() is None:
+            sys.exit('Cannot create database schema')
+        return run_backend(db, clan_tags, polls)
+    finally:
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('DROP SCHEMA IF EXISTS %s CASCADE;' % SCHEMA)
+            conn.commit()
+
+
+def run_sqlite(clan_tags, polls):
+    import db_sqlite
+
+    return run_backend(db_sqlite, clan_tags, polls)
+
+
+def run(clans, members, days, backends):
+    sqlite_dir = tempfile.mkdtemp(prefix='cr_storage_')
+    clan_tags = [CLAN_TAG + str(i) for i in range(clans)]
+    # settings are read on import, so the project modules are imported after environment is prepared
+    os.environ['CLAN_TAG'] = clan_tags[0]
+    os.environ['PGOPTIONS'] = '-c search_path=' + SCHEMA
+    os.environ['SQLITE_PATH'] = os.path.join(sqlite_dir, 'benchmark.sqlite3')
+    import utils
+
+    utils.logger.setLevel(logging.WARNING)
+    polls = [generate_polls(clan_tag, members, days, seed) for seed, clan_tag in enumerate(clan_tags)]
+    results = {}
+    try:
+        for backend in backends:
+            res = {'postgres': run_postgres, 'sqlite': run_sqlite}[backend](clan_tags, polls)
+            if res is not None:
+                results[backend] = res
+    finally:
+        shutil.rmtree(sqlite_dir)
+
+    print('%d clans of %d members, %d days, %d war battles' % (clans, members, days, clans * members * days * 4))
+    print('%-24s' % 'ms, median of runs' + ''.join('%12s' % b for b in results))
+    for name in next(iter(results.values()), {}):
+        print('%-24s' % name + ''.join('%12.2f' % res[name] for res in results.values()))
+
+
+if __name__ == '__main__':
+    def get_arg(name, default):
+        return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+    run(int(get_arg('--clans', 5)), int(get_arg('--members', 50)), int(get_arg('--days', 70)),
+        get_arg('--backends', 'postgres,sqlite').split(','))
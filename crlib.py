@@ -1,6 +1,43 @@
 # Common utils for accessing Clash Royale API
-import requests
+import hashlib
+import json
+import os
+import random
 import sys
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+import requests
+from decouple import config
+
+import metrics
+from utils import log
+
+API_URL = "https://api.clashroyale.com/v1"
+# default request rate is kept below the developer key limits
+API_RATE = config('CR_API_RATE', default=10, cast=float)
+API_BURST = config('CR_API_BURST', default=10, cast=int)
+API_MAX_RETRIES = config('CR_API_MAX_RETRIES', default=4, cast=int)
+API_TIMEOUT = config('CR_API_TIMEOUT', default=15, cast=float)
+# number of kept alive connections, should be not less than the number of threads making requests
+API_POOL_SIZE = config('CR_API_POOL_SIZE', default=10, cast=int)
+# exponential backoff: BACKOFF_BASE * 2 ^ attempt seconds, no more than BACKOFF_MAX
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# raw API responses are saved to CR_API_RECORD_DIR if it is set; with CR_API_REPLAY_DIR set, responses are
+# read from there instead of the API, optionally delayed by CR_API_REPLAY_LATENCY ms to simulate network
+API_RECORD_DIR = config('CR_API_RECORD_DIR', default='')
+API_REPLAY_DIR = config('CR_API_REPLAY_DIR', default='')
+API_REPLAY_LATENCY = config('CR_API_REPLAY_LATENCY', default=0, cast=float)
+# responses of the rarely changing endpoints (clan data with the member list) are cached in CR_API_CACHE_DIR
+# (empty to disable) for the endpoint TTL, minutes; no more than CR_API_CACHE_SIZE least recently used responses
+# are kept; battlelogs are never cached, they have to be fresh
+API_CACHE_DIR = config('CR_API_CACHE_DIR', default='.api_cache')
+API_CACHE_SIZE = config('CR_API_CACHE_SIZE', default=500, cast=int)
+API_CACHE_TTLS = {
+    "clan": config('CR_API_CLAN_CACHE_TTL', default=15, cast=float),
+}
 
 
 def load_auth():
@@ -12,30 +49,266 @@ def load_auth():
         sys.exit("Could not read authentication token, make sure one is available in an auth.txt file.")
 
 
-auth = load_auth()
+# Token bucket shared by all the threads making API requests: holds up to `capacity` tokens
+# and refills at `rate` tokens per second, every request takes one token
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # blocks until a token is available
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    # stops handing out tokens for `seconds`, used when the API reports we are over the limit
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated_at = self.paused_until
+            self.tokens = 0
+
+
+# On-disk LRU cache of API responses, one JSON file per request: {etag, fetched_at, data}
+# Recency is kept in file modification times, so eviction order survives restarts
+class ResponseCache:
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        # file name -> None, least recently used first; loaded from the directory on the first use
+        self.entries = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(path, params=None):
+        return hashlib.sha1(json.dumps([path, params], sort_keys=True).encode()).hexdigest() + ".json"
+
+    def _load_entries(self):
+        if self.entries is None:
+            try:
+                files = [e for e in os.scandir(self.directory) if e.name.endswith(".json")]
+            except FileNotFoundError:
+                files = []
+            self.entries = OrderedDict((e.name, None) for e in sorted(files, key=lambda e: e.stat().st_mtime))
+
+    # returns the cached entry or None
+    def get(self, key):
+        file_name = os.path.join(self.directory, key)
+        with self.lock:
+            self._load_entries()
+            if key not in self.entries:
+                return None
+            try:
+                with open(file_name, "r") as f:
+                    entry = json.load(f)
+                os.utime(file_name)
+            except (IOError, ValueError):
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, data, etag=None):
+        file_name = os.path.join(self.directory, key)
+        with self.lock:
+            self._load_entries()
+            os.makedirs(self.directory, exist_ok=True)
+            # written to a temporary file first, so that a concurrent process never reads a partial entry
+            with open(file_name + ".tmp", "w") as f:
+                json.dump({"etag": etag, "fetched_at": time.time(), "data": data}, f)
+            os.replace(file_name + ".tmp", file_name)
+            self.entries[key] = None
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except FileNotFoundError:
+                    pass
+
+
+# Rate limited CR API client, retries throttled (429), server side (5xx) and connection errors
+# with exponential backoff, honoring Retry-After header when API provides one
+# Connections are kept alive in a pool of the session shared by all the threads
+# Responses can be recorded to `record_dir` and replayed from `replay_dir`, see API_RECORD_DIR
+# Responses of the endpoints listed in `cache_ttls` are cached in `cache_dir`, see API_CACHE_DIR; expired ones are
+# revalidated with If-None-Match when the API returned an ETag, so an unchanged response is not downloaded again
+class ApiClient:
+    def __init__(self, rate=API_RATE, burst=API_BURST, max_retries=API_MAX_RETRIES, timeout=API_TIMEOUT,
+                 pool_size=API_POOL_SIZE, record_dir=API_RECORD_DIR, replay_dir=API_REPLAY_DIR,
+                 replay_latency=API_REPLAY_LATENCY, cache_dir=API_CACHE_DIR, cache_size=API_CACHE_SIZE,
+                 cache_ttls=API_CACHE_TTLS):
+        self.session = requests.Session()
+        # authorization header is set on the first request, so the token is not needed when responses are replayed
+        self.session.headers.update({"Accept": "application/json",
+                                     "Accept-Encoding": "gzip"})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount(API_URL, adapter)
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.record_dir = record_dir
+        self.replay_dir = replay_dir
+        self.replay_latency = replay_latency
+        self.cache = ResponseCache(cache_dir, cache_size) if cache_dir else None
+        self.cache_ttls = cache_ttls
+        # endpoint -> counters: requests, retries, throttled, errors, cached, not_modified
+        self.stats = defaultdict(Counter)
+        self.stats_lock = threading.Lock()
+        self.auth_lock = threading.Lock()
+
+    def _count(self, endpoint, counter):
+        with self.stats_lock:
+            self.stats[endpoint][counter] += 1
+        metrics.inc('api_' + counter, endpoint=endpoint)
+
+    @staticmethod
+    def _get_backoff(attempt, response=None):
+        if response is not None:
+            try:
+                return float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                pass
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+
+    # returns file name for the response of API `path`, e.g. players/ABC/battlelog.json
+    @staticmethod
+    def _get_fixture_path(directory, path):
+        return os.path.join(directory, *path.replace("%23", "").strip("/").split("/")) + ".json"
+
+    def _replay(self, endpoint, path):
+        self._count(endpoint, "replayed")
+        with metrics.timer('api_request_seconds', endpoint=endpoint):
+            if self.replay_latency:
+                time.sleep(self.replay_latency / 1000)
+            with open(self._get_fixture_path(self.replay_dir, path), "r") as f:
+                return json.load(f)
+
+    def _record(self, path, data):
+        file_name = self._get_fixture_path(self.record_dir, path)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, "w") as f:
+            json.dump(data, f)
+
+    # `endpoint` is a short name of the API method used for counters, `path` is relative to API_URL
+    def get(self, endpoint, path, params=None):
+        if self.replay_dir:
+            return self._replay(endpoint, path)
+        data = self._get_cached(endpoint, path, params)
+        # cached responses are recorded too, so that the recording is complete
+        if self.record_dir:
+            self._record(path, data)
+        return data
+
+    # returns the cached response if it hasn't expired yet, otherwise requests it from the API
+    def _get_cached(self, endpoint, path, params=None):
+        ttl = self.cache_ttls.get(endpoint) if self.cache is not None else None
+        entry = None
+        if ttl:
+            key = ResponseCache.get_key(path, params)
+            entry = self.cache.get(key)
+            if entry is not None and time.time() - entry["fetched_at"] < ttl * 60:
+                self._count(endpoint, "cached")
+                return entry["data"]
+        r = self._request(endpoint, path, params, entry["etag"] if entry is not None else None)
+        if r.status_code == 304:
+            self._count(endpoint, "not_modified")
+            data = entry["data"]
+        else:
+            data = r.json()
+        if ttl:
+            try:
+                self.cache.put(key, data, r.headers.get("ETag") or (entry["etag"] if r.status_code == 304 else None))
+            except OSError as e:
+                log('Cannot cache CR API %s response: %s' % (endpoint, str(e)))
+        return data
+
+    # returns the response, which is 304 Not Modified if `etag` is set and the response hasn't changed
+    def _request(self, endpoint, path, params=None, etag=None):
+        with self.auth_lock:
+            if "authorization" not in self.session.headers:
+                self.session.headers["authorization"] = load_auth()
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self._count(endpoint, "requests")
+            try:
+                with metrics.timer('api_request_seconds', endpoint=endpoint):
+                    r = self.session.get(API_URL + path, params=params, timeout=self.timeout,
+                                         headers={"If-None-Match": etag} if etag else None)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    self._count(endpoint, "errors")
+                    raise
+                delay = self._get_backoff(attempt)
+                log('CR API %s request failed (%s), retrying in %.1fs' % (endpoint, str(e), delay))
+            else:
+                if r.status_code != 429 and r.status_code < 500:
+                    if not r.ok:
+                        self._count(endpoint, "errors")
+                    r.raise_for_status()
+                    return r
+                if attempt == self.max_retries:
+                    self._count(endpoint, "errors")
+                    r.raise_for_status()
+                delay = self._get_backoff(attempt, r)
+                if r.status_code == 429:
+                    self._count(endpoint, "throttled")
+                    # the limit is per API key, so all threads should slow down
+                    self.bucket.pause(delay)
+                log('CR API %s request returned %d, retrying in %.1fs' % (endpoint, r.status_code, delay))
+            self._count(endpoint, "retries")
+            time.sleep(delay)
+
+    def get_stats_summary(self):
+        with self.stats_lock:
+            return ', '.join('%s: %s' % (endpoint, ' '.join('%s=%d' % (k, v) for k, v in sorted(counters.items())))
+                             for endpoint, counters in sorted(self.stats.items()))
+
+
+client = ApiClient()
+
 
+# Clan member record from the clan API response, has everything we need to know about player
+# without requesting the player profile
+class ClanMember:
+    def __init__(self, data):
+        self.tag = data["tag"][1:]
+        self.name = data["name"]
+        self.role = data.get("role")
+        self.exp_level = data.get("expLevel")
+        self.trophies = data.get("trophies")
+        self.last_seen = data.get("lastSeen")
 
-def get_clan_name(clan_tag):
-    r = requests.get("https://api.clashroyale.com/v1/clans/%23" + clan_tag,
-                     headers={"Accept": "application/json", "authorization": auth},
-                     params={"limit": 50, "clanTag": clan_tag})
-    return r.json()["name"]
 
+class Clan:
+    def __init__(self, data):
+        self.tag = data["tag"][1:]
+        self.name = data["name"]
+        self.members = [ClanMember(m) for m in data.get("memberList", [])]
 
-def get_player_name(player_tag):
-    r = requests.get("https://api.clashroyale.com/v1/players/%23" + player_tag,
-                     headers={"Accept": "application/json", "authorization": auth},
-                     params={"limit": 50, "playerTag": player_tag})
-    return r.json()["name"]
 
+# returns clan data including all the members, in one request
+def get_clan(clan_tag):
+    return Clan(client.get("clan", "/clans/%23" + clan_tag))
 
-def clan_member_tags(ct):
-    tags = []
-    r = requests.get("https://api.clashroyale.com/v1/clans/%23" + ct + "/members",
-                     headers={"Accept": "application/json", "authorization": auth},
-                     params={"limit": 50})
 
-    members = r.json()["items"]
-    for m in members:
-        tags.append(m["tag"][1:])
-    return tags
+def get_battlelog(player_tag):
+    return client.get("battlelog", "/players/%23" + player_tag + "/battlelog", params={"limit": 100})
@@ -0,0 +1,109 @@
+# Long-running mode replacing cron: the API client, database connections and other clients are created once and
+# kept warm, tracked clans are polled every POLL_INTERVAL minutes. Close to the war day end polling is more frequent
+# (BOUNDARY_POLL_INTERVAL minutes during the last BOUNDARY_WINDOW minutes), and one more poll is made right before
+# the end. Discord notifications are sent at exact NOTIFICATION_TIMES (comma separated HH:MM, UTC).
+# With ADAPTIVE_POLLING on, clans are checked every POLL_TICK minutes instead, and only the players due according to
+# their battle rate are polled (see polling.py); polls close to the war day end and before notifications still load
+# all the players.
+# Usage: python daemon.py
+import datetime
+import signal
+import threading
+
+from decouple import config, Csv
+
+import CW2DayAnalysis as analysis
+import metrics
+from notifier import notifier
+from polling import PollScheduler
+from utils import log, err
+
+POLL_INTERVAL = datetime.timedelta(minutes=config('POLL_INTERVAL', default=30, cast=int))
+BOUNDARY_POLL_INTERVAL = datetime.timedelta(minutes=config('BOUNDARY_POLL_INTERVAL', default=5, cast=int))
+BOUNDARY_WINDOW = datetime.timedelta(minutes=config('BOUNDARY_WINDOW', default=60, cast=int))
+ADAPTIVE_POLLING = config('ADAPTIVE_POLLING', default=True, cast=bool)
+POLL_TICK = datetime.timedelta(minutes=config('POLL_TICK', default=5, cast=int))
+# the last poll of the war day is made this long before its end
+FINAL_POLL_ADVANCE = datetime.timedelta(minutes=1)
+NOTIFICATION_TIMES = config('NOTIFICATION_TIMES', default=','.join('%02d:00' % h for h in analysis.REPORT_HOURS),
+                            cast=Csv())
+
+stop_event = threading.Event()
+
+
+def _parse_time(time_string):
+    hours, minutes = time_string.split(':')
+    return datetime.time(int(hours), int(minutes))
+
+
+# returns the first of the daily notification times after `now`, None if there are no notifications
+def get_next_notification_time(now):
+    res = None
+    for t in NOTIFICATION_TIMES:
+        dt = datetime.datetime.combine(now.date(), _parse_time(t))
+        if dt <= now:
+            dt += datetime.timedelta(days=1)
+        if res is None or dt < res:
+            res = dt
+    return res
+
+
+# returns the time of the next poll, whether notification should be sent after it, and whether all the players
+# should be polled regardless of the adaptive schedule
+def get_next_poll(now):
+    war_day_end = analysis.get_war_day_end(now)
+    boundary_window_start = war_day_end - BOUNDARY_WINDOW
+    final_poll = war_day_end - FINAL_POLL_ADVANCE
+
+    if now >= boundary_window_start:
+        interval = BOUNDARY_POLL_INTERVAL
+    else:
+        interval = POLL_TICK if ADAPTIVE_POLLING else POLL_INTERVAL
+    next_poll = now + interval
+    for t in (boundary_window_start, final_poll):
+        if now < t < next_poll:
+            next_poll = t
+
+    next_notification = get_next_notification_time(now)
+    if next_notification is not None and next_notification <= next_poll:
+        return next_notification, True, True
+    return next_poll, False, not ADAPTIVE_POLLING or next_poll >= boundary_window_start
+
+
+def stop(signum, frame):
+    log('Stopping daemon')
+    stop_event.set()
+
+
+def run():
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    clan_tags = analysis.get_tracked_clan_tags()
+    log('Daemon started for clans with tags ' + ', '.join(clan_tags))
+    if metrics.METRICS_PORT:
+        metrics.start_http_server(metrics.METRICS_PORT)
+        log('Metrics are served on port %d' % metrics.METRICS_PORT)
+    scheduler = None
+    if ADAPTIVE_POLLING:
+        scheduler = PollScheduler()
+        scheduler.load_history(datetime.datetime.utcnow())
+
+    notify = False
+    poll_all = True
+    while not stop_event.is_set():
+        try:
+            analysis.run_report(clan_tags, True, notify, scheduler, poll_all)
+        except Exception as e:
+            err('Poll failed: ' + str(e))
+
+        next_poll, notify, poll_all = get_next_poll(datetime.datetime.utcnow())
+        log('Next poll at %s%s%s' % (next_poll.strftime('%H:%M:%S'), ' with notification' if notify else '',
+                                     ' of all the players' if poll_all and scheduler is not None else ''))
+        stop_event.wait(max(0, (next_poll - datetime.datetime.utcnow()).total_seconds()))
+    if not notifier.flush(analysis.NOTIFICATION_FLUSH_TIMEOUT):
+        err('Queued notifications are not sent')
+    log('Daemon stopped')
+
+
+if __name__ == '__main__':
+    run()
@@ -1,227 +1,326 @@
-import datetime
+import threading
+import time
+from contextlib import contextmanager
 
-import psycopg2
 from decouple import config
 
+import metrics
 from utils import log, err
 
-QUERY_MARK_LEAVERS = "UPDATE player SET is_in_clan = id IN (%s);"
-QUERY_INSERT_PLAYER = """
-    INSERT INTO player (tag, name) VALUES ('%s', '%s')
-    ON CONFLICT (tag) 
-    DO 
+# psycopg2 is imported by the functions using it, so that the modules importing db stay fast to start when the
+# database is not used (e.g. manual mode)
+
+QUERY_MARK_LEAVERS = "UPDATE player SET is_in_clan = id = ANY(%s) WHERE clan_tag = %s;"
+QUERY_UPSERT_CLAN = """
+    INSERT INTO clan (tag, name) VALUES (%s, %s)
+    ON CONFLICT (tag)
+    DO
     UPDATE SET name = EXCLUDED.name;
-    SELECT id FROM player WHERE tag = '%s';
 """
-QUERY_INSERT_BATTLE = """
-    INSERT INTO war_battle (player_id, battle_timestamp, war_day, decks_used, decks_won, fame)\n
-    VALUES (%d, '%s', '%s', %d, %d, %d);
+# bulk queries, VALUES %s are filled in by execute_values
+QUERY_UPSERT_PLAYERS = """
+    INSERT INTO player (tag, name, clan_tag) VALUES %s
+    ON CONFLICT (tag)
+    DO
+    UPDATE SET name = EXCLUDED.name, clan_tag = EXCLUDED.clan_tag, is_in_clan = True
+    RETURNING tag, id;
+"""
+# battles that are actually inserted are added to player_war_day totals
+QUERY_INSERT_BATTLES = """
+    WITH new_battle AS (
+        INSERT INTO war_battle (clan_tag, player_id, battle_timestamp, war_day, decks_used, decks_won, fame,
+            is_boat_attack)
+        VALUES %s
+        ON CONFLICT (player_id, battle_timestamp) DO NOTHING
+        RETURNING clan_tag, player_id, war_day, decks_used, decks_won, fame, is_boat_attack
+    ), war_day_totals AS (
+    INSERT INTO player_war_day AS pwd (clan_tag, player_id, war_day, played, won, fame, boat_attacks)
+    SELECT clan_tag, player_id, war_day, SUM(decks_used), SUM(decks_won), SUM(COALESCE(fame, 0)),
+        COUNT(*) FILTER (WHERE is_boat_attack)
+    FROM new_battle
+    GROUP BY clan_tag, player_id, war_day
+    ON CONFLICT (clan_tag, player_id, war_day)
+    DO
+    UPDATE SET played = pwd.played + EXCLUDED.played,
+        won = pwd.won + EXCLUDED.won,
+        fame = pwd.fame + EXCLUDED.fame,
+        boat_attacks = pwd.boat_attacks + EXCLUDED.boat_attacks
+    )
+    SELECT count(*) FROM new_battle;
+"""
+QUERY_UPDATE_BATTLE_CURSORS = """
+    UPDATE player p SET last_battle_timestamp = c.last_battle_timestamp
+    FROM (VALUES %s) AS c (id, last_battle_timestamp)
+    WHERE p.id = c.id AND (p.last_battle_timestamp IS NULL OR p.last_battle_timestamp < c.last_battle_timestamp);
 """
+# number of rows sent in one statement by execute_values
+BULK_PAGE_SIZE = 1000
 
+QUERY_GET_BATTLE_CURSORS = """
+    SELECT tag, last_battle_timestamp FROM player WHERE tag = ANY(%s) AND last_battle_timestamp IS NOT NULL;
+"""
+QUERY_GET_PLAYER_BATTLE_COUNTS = """
+    SELECT p.tag, SUM(pwd.played)
+    FROM player_war_day pwd
+    JOIN player p ON p.id = pwd.player_id
+    WHERE pwd.war_day >= %s
+    GROUP BY p.tag
+"""
+
+# read queries take (clan tag, ...) parameters, players are listed in the clan report if they are currently
+# in the clan or played for it during the report period
 QUERY_GET_LAST_WEEK_STATS = """
-    SELECT wb.war_day, SUM(wb.decks_used) as played, SUM(wb.decks_won) as won, p.id as player_id, p.name,
-        p.is_in_clan
+    SELECT pwd.war_day, pwd.played, pwd.won, p.id as player_id, p.name, p.is_in_clan AND p.clan_tag = %(clan)s
     FROM player p
-    LEFT JOIN war_battle wb ON wb.player_id = p.id AND wb.war_day >= '%s'
-    WHERE p.is_in_clan OR wb.id is not NULL
-    GROUP BY p.id, wb.war_day
-    ORDER BY p.is_in_clan DESC, p.id, wb.war_day
+    LEFT JOIN player_war_day pwd ON pwd.player_id = p.id AND pwd.clan_tag = %(clan)s AND pwd.war_day >= %(day)s
+    WHERE (p.is_in_clan AND p.clan_tag = %(clan)s) OR pwd.player_id is not NULL
+    ORDER BY 6 DESC, p.id, pwd.war_day
 """
 
-QUERY_CLEAR_NOTIFICATION_IDS = 'UPDATE player SET discord_id = NULL;'
-
-QUERY_UPDATE_PLAYER_NOTIFICATION_ID = """
-    UPDATE player
-    SET discord_id = '%s', is_mini = %s
-    WHERE tag = '%s';
+# applies the whole mapping in one statement: mapped players get their ids, the rest lose them;
+# only the rows that actually change are updated
+QUERY_SYNC_NOTIFICATION_IDS = """
+    UPDATE player p SET discord_id = m.discord_id, is_mini = COALESCE(m.is_mini, p.is_mini)
+    FROM player p2
+    LEFT JOIN (
+        SELECT unnest(%(tags)s::varchar[]) AS tag, unnest(%(discord_ids)s::varchar[]) AS discord_id,
+            unnest(%(is_mini)s::bool[]) AS is_mini
+    ) m ON m.tag = p2.tag
+    WHERE p.id = p2.id
+        AND (p.discord_id IS DISTINCT FROM m.discord_id OR p.is_mini IS DISTINCT FROM COALESCE(m.is_mini, p.is_mini));
 """
 
 QUERY_GET_WAR_DAY_STATS = """
-    SELECT count(players) as players, sum(played) as played, sum(won) as won 
-    FROM (
-        SELECT count(*) as players, sum(decks_used) as played, sum(decks_won) as won
-        FROM war_battle
-        WHERE war_day = '%s'
-        GROUP BY player_id
-    ) as p
+    SELECT count(*) as players, sum(played) as played, sum(won) as won
+    FROM player_war_day
+    WHERE clan_tag = %(clan)s AND war_day = %(day)s
 """
 
 QUERY_GET_WAR_DAY_PLAYER_STATS = """
-    SELECT p.name, p.discord_id, p.is_in_clan, p.is_mini, SUM(COALESCE(wb.decks_used, 0)) as used
+    SELECT p.name, p.discord_id, p.is_in_clan AND p.clan_tag = %(clan)s, p.is_mini, COALESCE(pwd.played, 0) as used
     FROM player p
-    LEFT JOIN war_battle wb ON wb.player_id = p.id AND wb.war_day = '%s'
-    WHERE p.is_in_clan OR wb.decks_used is NOT NULL
-    GROUP BY p.id
-    HAVING SUM(COALESCE(wb.decks_used, 0)) < 4
+    LEFT JOIN player_war_day pwd ON pwd.player_id = p.id AND pwd.clan_tag = %(clan)s AND pwd.war_day = %(day)s
+    WHERE ((p.is_in_clan AND p.clan_tag = %(clan)s) OR pwd.player_id IS NOT NULL) AND COALESCE(pwd.played, 0) < 4
     ORDER BY 5;
 """
 
 
-def get_connection():
+# maximum number of simultaneously open database connections
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=4, cast=int)
+# after a failed attempt to connect, the next one is made no earlier than in this number of seconds
+DB_RECONNECT_INTERVAL = 60
+# pooled connections idle for longer than this number of seconds are checked before use, the ones used recently
+# are assumed to be alive, so most queries don't pay for an extra round trip
+DB_HEALTH_CHECK_IDLE = 60
+
+_pool = None
+_pool_failed_at = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises an error when all connections are in use, this makes threads wait instead
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+# connection -> time.monotonic it was returned to the pool
+_returned_at = {}
+
+
+# returns connection pool, creating it on the first use; returns None if database is not available
+def _get_pool():
+    global _pool, _pool_failed_at
+    from psycopg2.pool import ThreadedConnectionPool
+    with _pool_lock:
+        if _pool is None and (_pool_failed_at is None or time.monotonic() - _pool_failed_at > DB_RECONNECT_INTERVAL):
+            try:
+                _pool = ThreadedConnectionPool(
+                    1, DB_POOL_SIZE,
+                    database=config('DB_DATABASE'),
+                    user=config('DB_USER'),
+                    password=config('DB_PASSWORD'),
+                    host='127.0.0.1',
+                    port=config('DB_PORT')
+                )
+                _pool_failed_at = None
+            except Exception as e:
+                _pool_failed_at = time.monotonic()
+                log('Database connection failed, the data will not be saved: ' + str(e))
+        return _pool
+
+
+def _is_healthy(connection):
+    import psycopg2
+    if connection.closed:
+        return False
+    returned_at = _returned_at.get(connection)
+    # a new connection or one used recently
+    if returned_at is None or time.monotonic() - returned_at < DB_HEALTH_CHECK_IDLE:
+        return True
     try:
-        return psycopg2.connect(
-            database=config('DB_DATABASE'),
-            user=config('DB_USER'),
-            password=config('DB_PASSWORD'),
-            host='127.0.0.1',
-            port=config('DB_PORT')
-        )
-    except Exception as e:
-        log('Database connection failed, the data will not be saved: ' + str(e))
-        return None
-
-
-conn = get_connection()
-
-
-def _execute_query(query_str, ignore_duplication_errors=False):
-    if conn is None:
+        with connection.cursor() as cur:
+            cur.execute('SELECT 1')
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+# yields a healthy connection from the pool or None if there is no database
+# connections broken while in use are closed instead of being returned to the pool
+@contextmanager
+def connection():
+    pool = _get_pool()
+    if pool is None:
+        yield None
         return
-    cur = conn.cursor()
-    try:
-        cur.execute(query_str)
-        cur.close()
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        if not ignore_duplication_errors or 'duplicate' not in str(e):
-            err('Cannot execute database query: ' + str(e))
-
-
-def _fetch_query(query_str):
-    if conn is None:
-        return None
-    cur = conn.cursor()
-    res = None
-    try:
-        cur.execute(query_str)
-        res = cur.fetchall()
-    except Exception as e:
-        err('Cannot get run select query: ' + str(e))
+    import psycopg2
+    with _pool_slots:
+        try:
+            conn = pool.getconn()
+            # after database restart all the pooled connections are broken, so we may need to replace all of them
+            for _ in range(DB_POOL_SIZE):
+                if _is_healthy(conn):
+                    break
+                log('Database connection is lost, reconnecting')
+                _returned_at.pop(conn, None)
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except psycopg2.Error as e:
+            err('Cannot connect to database: ' + str(e))
+            conn = None
+        try:
+            yield conn
+        finally:
+            if conn is not None:
+                if conn.closed:
+                    _returned_at.pop(conn, None)
+                else:
+                    _returned_at[conn] = time.monotonic()
+                pool.putconn(conn, close=bool(conn.closed))
+
+
+# returns True if the query is executed (or failed on duplication if such errors are ignored)
+def _execute_query(query_str, ignore_duplication_errors=False, params=None):
+    with connection() as conn:
+        if conn is None:
+            return False
+        cur = conn.cursor()
+        try:
+            cur.execute(query_str, params)
+            cur.close()
+            conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            if not ignore_duplication_errors or 'duplicate' not in str(e):
+                err('Cannot execute database query: ' + str(e))
+                return False
+            return True
+
+
+def _fetch_query(query_str, params=None):
+    with connection() as conn:
+        if conn is None:
+            return None
+        cur = conn.cursor()
+        res = None
+        try:
+            cur.execute(query_str, params)
+            res = cur.fetchall()
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            err('Cannot get run select query: ' + str(e))
+            return res
+        finally:
+            cur.close()
         return res
-    finally:
-        cur.close()
-    return res
 
 
-# marks players not listed in the `players_in_clan` list as the ones not currently in clan
-def mark_leavers(players_in_clan):
-    _execute_query(QUERY_MARK_LEAVERS % ','.join(str(p) for p in players_in_clan))
+# marks players of the clan not listed in the `players_in_clan` list as the ones not currently in clan
+def mark_leavers(clan_tag, players_in_clan):
+    _execute_query(QUERY_MARK_LEAVERS, params=(list(players_in_clan), clan_tag))
 
 
-# returns player id from the database; if record doesn't exist, creates it
-def get_player_id(player_tag, player_name):
-    if conn is None:
+# saves all the data of a clan collected during the run in one transaction:
+# `clan` - (tag, name), the clan is created or renamed
+# `players` - list of (tag, name) of the clan members, missing players are created, existing ones get the name
+# and clan updated
+# `battles` - list of (player tag, timestamp, war_day, decks_used, decks_won, fame, is_boat_attack); if a record
+# with the same timestamp exists for a user, it is skipped (assume two different battles cannot happen at the same
+# time for the same player); saved battles are added to player_war_day totals
+# `cursors` - {player tag: timestamp of the latest battle seen}, moved forward only
+# returns {player tag: player id}, or None if nothing is saved
+def save_war_data(clan, players, battles, cursors):
+    from psycopg2.extras import execute_values
+    if not players:
         return None
-    cur = conn.cursor()
-    try:
-        cur.execute(QUERY_INSERT_PLAYER % (player_tag, player_name.replace("'", "\\'"), player_tag))
-        res = cur.fetchone()
-        player_id = res[0]
-        cur.close()
-        conn.commit()
-        return player_id
-    except Exception as e:
-        conn.rollback()
-        err('Cannot get or create user: ' + str(e))
-        return None
-
-
-# saves database record for a war battle; if player_id is None, does nothing
-# if a record with the same timestamp exists for a user, does nothing (assume two different battles
-# cannot happen at the same time for the same player)
-def save_battle(player_id, timestamp, war_day, decks_used, decks_won, fame):
-    _execute_query(QUERY_INSERT_BATTLE % (player_id, timestamp, war_day, decks_used, decks_won, fame), True)
-
-
-def reset_notification_ids():
-    _execute_query(QUERY_CLEAR_NOTIFICATION_IDS)
-
-
-def set_player_notification_id(player_tag, notification_id, is_mini):
-    _execute_query(QUERY_UPDATE_PLAYER_NOTIFICATION_ID % (notification_id.replace("'", "\\'"),
-                                                          is_mini,
-                                                          player_tag.replace("'", "\\'")))
+    clan_tag = clan[0]
+    with connection() as conn:
+        if conn is None:
+            return None
+        cur = conn.cursor()
+        try:
+            cur.execute(QUERY_UPSERT_CLAN, clan)
+            player_ids = dict(execute_values(cur, QUERY_UPSERT_PLAYERS, [p + (clan_tag,) for p in players],
+                                             page_size=BULK_PAGE_SIZE, fetch=True))
+            inserted = 0
+            if battles:
+                inserted = sum(row[0] for row in execute_values(
+                    cur, QUERY_INSERT_BATTLES, [(clan_tag, player_ids[b[0]]) + tuple(b[1:]) for b in battles],
+                    page_size=BULK_PAGE_SIZE, fetch=True))
+            if cursors:
+                execute_values(cur, QUERY_UPDATE_BATTLE_CURSORS,
+                               [(player_ids[tag], timestamp) for tag, timestamp in cursors.items()],
+                               page_size=BULK_PAGE_SIZE)
+            conn.commit()
+            metrics.inc('war_battles_inserted', inserted)
+            metrics.inc('war_battles_duplicated', len(battles) - inserted)
+            return player_ids
+        except Exception as e:
+            conn.rollback()
+            err('Cannot save war data: ' + str(e))
+            return None
+        finally:
+            cur.close()
+
+
+# returns timestamps of the latest battles already saved for players `player_tags`: {player tag: datetime}
+def get_battle_cursors(player_tags):
+    res = _fetch_query(QUERY_GET_BATTLE_CURSORS, (list(player_tags),))
+    return dict(res) if res else {}
+
+
+# returns the number of war battles played by players since `war_day`: {player tag: battles}
+def get_player_battle_counts(war_day):
+    res = _fetch_query(QUERY_GET_PLAYER_BATTLE_COUNTS, (war_day,))
+    return dict(res) if res else {}
+
+
+# `mapping` is {player tag: (discord id, is mini)}, returns the number of updated players or None on error
+def sync_notification_ids(mapping):
+    with connection() as conn:
+        if conn is None:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(QUERY_SYNC_NOTIFICATION_IDS, {'tags': list(mapping),
+                                                          'discord_ids': [v[0] for v in mapping.values()],
+                                                          'is_mini': [v[1] for v in mapping.values()]})
+                updated = cur.rowcount
+            conn.commit()
+            return updated
+        except Exception as e:
+            conn.rollback()
+            err('Error updating notification ids: ' + str(e))
+            return None
 
 
-def get_war_day_stats(war_day):
-    return _fetch_query(QUERY_GET_WAR_DAY_STATS % war_day)
+def get_war_day_stats(clan_tag, war_day):
+    return _fetch_query(QUERY_GET_WAR_DAY_STATS, {'clan': clan_tag, 'day': war_day})
 
 
-def get_war_day_player_stats(war_day):
-    return _fetch_query(QUERY_GET_WAR_DAY_PLAYER_STATS % war_day)
+def get_war_day_player_stats(clan_tag, war_day):
+    return _fetch_query(QUERY_GET_WAR_DAY_PLAYER_STATS, {'clan': clan_tag, 'day': war_day})
 
 
-# returns two-dimensional array for export. Format:
-# [[Report date][<datetime>]]
-# [[Player][Played <date (Sun)>][Won <date (Sun)>]...[Played <date (today)>][Won <date (today)>]]
-def get_report(cutout_date):
-    def set_item(i, j, v):
-        try:
-            res[i][j] = v
-        except IndexError:
-            for _ in range(i - len(res) + 1):
-                res.append([])
-            for _ in range(j - len(res[i]) + 1):
-                res[i].append(None)
-            res[i][j] = v
-
-    def get_day_index(war_day):
-        return (war_day - cutout_datetime.date()).days
-
-    if conn is None:
-        return None
-    res = []
-    cutout_datetime = datetime.datetime.strptime(cutout_date, '%Y-%m-%d')
-
-    today = datetime.datetime.utcnow()
-    days_in_report = get_day_index(today.date()) + 1
-
-    set_item(0, 0, 'Last update: ' + today.strftime('%d-%m-%Y %H:%M:%S'))
-    # filling in table header
-    for d in range(days_in_report):
-        set_item(0, 1 + d * 2, (cutout_datetime + datetime.timedelta(days=d)).date().strftime('%d-%m-%Y'))
-        set_item(1, 1 + d * 2, 'played')
-        set_item(1, 1 + d * 2 + 1, 'won')
-
-    # iterating through query result, each row is a player's war day
-    # row_idx = 2 will make it start from row 3 (we increment in the beginning), first 3 rows are reserved
-    # for headers and totals
-    row_idx = 2
-    last_player_id = None
-    cur = conn.cursor()
-    try:
-        cur.execute(QUERY_GET_LAST_WEEK_STATS % cutout_date)
-        for row in cur:
-            if row[3] != last_player_id:
-                row_idx += 1
-                last_player_id = row[3]
-                set_item(row_idx, 0, row[4] + (' (not in clan)' if not row[5] else ''))
-            if row[0] is not None:
-                col = get_day_index(row[0])
-                set_item(row_idx, col * 2 + 1, row[1])
-                set_item(row_idx, col * 2 + 2, row[2])
-    finally:
-        cur.close()
-
-    # counting totals and averages
-    set_item(2, 0, 'TOTAL')
-    for d in range(days_in_report):
-        day_battles_played = 0
-        day_battles_won = 0
-        day_players = 0
-        for p in range(2, len(res)):
-            try:
-                day_battles_played += res[p][1 + d * 2] or 0
-                day_battles_won += res[p][1 + d * 2 + 1] or 0
-                if day_battles_played:
-                    day_players += 1
-            except IndexError:
-                pass
-
-        if day_battles_played > 0:
-            # maximum number of battles per clan per day is 50 * 4 = 200, print % of those that are actually played
-            set_item(2, 1 + d * 2, str(round(100 * day_battles_played / 200, 2)) + '% (' + str(day_players) + ')')
-            set_item(2, 1 + d * 2 + 1, str(round(100 * day_battles_won / day_battles_played, 2)) + '%')
-
-    return res
+# returns (war_day, played, won, player_id, name, is_in_clan) rows of the clan players since `since` war day,
+# ordered by player, see QUERY_GET_LAST_WEEK_STATS
+def get_player_war_days(clan_tag, since):
+    return _fetch_query(QUERY_GET_LAST_WEEK_STATS, {'clan': clan_tag, 'day': since})
@@ -0,0 +1,260 @@
+# SQLite storage backend, see storage.py: keeps all the data in a local SQLITE_PATH file, so no database server is
+# needed; the schema is created when the file is opened for the first time
+# Implements the same functions as db.py, with the same arguments and results
+import datetime
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from decouple import config
+
+import metrics
+from utils import err
+
+SQLITE_PATH = config('SQLITE_PATH', default='crwar.sqlite3')
+
+# the same tables as the Postgres migrations create; player_war_day totals are maintained by a trigger,
+# which is only fired for battles actually inserted
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS clan (
+        tag TEXT PRIMARY KEY,
+        name TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS player (
+        id INTEGER PRIMARY KEY,
+        tag TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        discord_id TEXT NULL,
+        is_in_clan BOOL NOT NULL DEFAULT 1,
+        is_mini BOOL NOT NULL DEFAULT 0,
+        last_battle_timestamp TEXT NULL,
+        clan_tag TEXT NOT NULL REFERENCES clan (tag)
+    );
+    CREATE INDEX IF NOT EXISTS player_clan_tag_idx ON player (clan_tag);
+
+    CREATE TABLE IF NOT EXISTS war_battle (
+        id INTEGER PRIMARY KEY,
+        clan_tag TEXT NOT NULL REFERENCES clan (tag),
+        player_id INT NOT NULL REFERENCES player (id),
+        battle_timestamp TEXT NOT NULL,
+        war_day TEXT NOT NULL,
+        decks_used INT NOT NULL DEFAULT 1,
+        decks_won INT NOT NULL DEFAULT 1,
+        fame INT,
+        is_boat_attack BOOL NOT NULL DEFAULT 0,
+
+        UNIQUE (player_id, battle_timestamp)
+    );
+
+    CREATE TABLE IF NOT EXISTS player_war_day (
+        clan_tag TEXT NOT NULL REFERENCES clan (tag),
+        player_id INT NOT NULL REFERENCES player (id),
+        war_day TEXT NOT NULL,
+        played INT NOT NULL DEFAULT 0,
+        won INT NOT NULL DEFAULT 0,
+        fame INT NOT NULL DEFAULT 0,
+        boat_attacks INT NOT NULL DEFAULT 0,
+
+        PRIMARY KEY (clan_tag, player_id, war_day)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS player_war_day_war_day_idx ON player_war_day (clan_tag, war_day, player_id, played, won);
+
+    CREATE TRIGGER IF NOT EXISTS war_battle_player_war_day AFTER INSERT ON war_battle
+    BEGIN
+        INSERT INTO player_war_day (clan_tag, player_id, war_day, played, won, fame, boat_attacks)
+        VALUES (NEW.clan_tag, NEW.player_id, NEW.war_day, NEW.decks_used, NEW.decks_won, COALESCE(NEW.fame, 0),
+            NEW.is_boat_attack)
+        ON CONFLICT (clan_tag, player_id, war_day)
+        DO
+        UPDATE SET played = played + EXCLUDED.played,
+            won = won + EXCLUDED.won,
+            fame = fame + EXCLUDED.fame,
+            boat_attacks = boat_attacks + EXCLUDED.boat_attacks;
+    END;
+"""
+
+# lists of values are passed as JSON arrays and read with json_each
+QUERY_MARK_LEAVERS = """
+    UPDATE player SET is_in_clan = id IN (SELECT value FROM json_each(?))
+    WHERE clan_tag = ?;
+"""
+QUERY_UPSERT_CLAN = """
+    INSERT INTO clan (tag, name) VALUES (?, ?)
+    ON CONFLICT (tag)
+    DO
+    UPDATE SET name = EXCLUDED.name;
+"""
+QUERY_UPSERT_PLAYERS = """
+    INSERT INTO player (tag, name, clan_tag) VALUES (?, ?, ?)
+    ON CONFLICT (tag)
+    DO
+    UPDATE SET name = EXCLUDED.name, clan_tag = EXCLUDED.clan_tag, is_in_clan = 1;
+"""
+QUERY_GET_PLAYER_IDS = "SELECT tag, id FROM player WHERE tag IN (SELECT value FROM json_each(?));"
+QUERY_INSERT_BATTLE = """
+    INSERT INTO war_battle (clan_tag, player_id, battle_timestamp, war_day, decks_used, decks_won, fame,
+        is_boat_attack)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (player_id, battle_timestamp) DO NOTHING;
+"""
+QUERY_UPDATE_BATTLE_CURSOR = """
+    UPDATE player SET last_battle_timestamp = :ts
+    WHERE id = :id AND (last_battle_timestamp IS NULL OR last_battle_timestamp < :ts);
+"""
+
+QUERY_GET_BATTLE_CURSORS = """
+    SELECT tag, last_battle_timestamp FROM player
+    WHERE tag IN (SELECT value FROM json_each(?)) AND last_battle_timestamp IS NOT NULL;
+"""
+QUERY_GET_PLAYER_BATTLE_COUNTS = """
+    SELECT p.tag, SUM(pwd.played)
+    FROM player_war_day pwd
+    JOIN player p ON p.id = pwd.player_id
+    WHERE pwd.war_day >= ?
+    GROUP BY p.tag
+"""
+
+QUERY_GET_PLAYER_WAR_DAYS = """
+    SELECT pwd.war_day, pwd.played, pwd.won, p.id as player_id, p.name, p.is_in_clan AND p.clan_tag = :clan
+    FROM player p
+    LEFT JOIN player_war_day pwd ON pwd.player_id = p.id AND pwd.clan_tag = :clan AND pwd.war_day >= :day
+    WHERE (p.is_in_clan AND p.clan_tag = :clan) OR pwd.player_id is not NULL
+    ORDER BY 6 DESC, p.id, pwd.war_day
+"""
+
+# mapping is a JSON array of [tag, discord id, is mini]
+QUERY_SYNC_NOTIFICATION_IDS = """
+    UPDATE player SET discord_id = m.discord_id, is_mini = COALESCE(m.is_mini, player.is_mini)
+    FROM player p2
+    LEFT JOIN (
+        SELECT json_extract(value, '$[0]') AS tag, json_extract(value, '$[1]') AS discord_id,
+            json_extract(value, '$[2]') AS is_mini
+        FROM json_each(?)
+    ) m ON m.tag = p2.tag
+    WHERE player.id = p2.id
+        AND (player.discord_id IS NOT m.discord_id OR player.is_mini IS NOT COALESCE(m.is_mini, player.is_mini));
+"""
+
+QUERY_GET_WAR_DAY_STATS = """
+    SELECT count(*) as players, sum(played) as played, sum(won) as won
+    FROM player_war_day
+    WHERE clan_tag = :clan AND war_day = :day
+"""
+
+QUERY_GET_WAR_DAY_PLAYER_STATS = """
+    SELECT p.name, p.discord_id, p.is_in_clan AND p.clan_tag = :clan, p.is_mini, COALESCE(pwd.played, 0) as used
+    FROM player p
+    LEFT JOIN player_war_day pwd ON pwd.player_id = p.id AND pwd.clan_tag = :clan AND pwd.war_day = :day
+    WHERE ((p.is_in_clan AND p.clan_tag = :clan) OR pwd.player_id IS NOT NULL) AND COALESCE(pwd.played, 0) < 4
+    ORDER BY 5;
+"""
+
+_connection = None
+# the connection is shared by all the threads, one at a time
+_connection_lock = threading.Lock()
+
+
+# yields the connection, opening it and creating the schema on the first use
+@contextmanager
+def connection():
+    global _connection
+    with _connection_lock:
+        if _connection is None:
+            _connection = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+            _connection.execute('PRAGMA journal_mode = WAL;')
+            _connection.execute('PRAGMA foreign_keys = ON;')
+            _connection.executescript(SCHEMA)
+        yield _connection
+
+
+def _fetch_query(query_str, params=()):
+    with connection() as conn:
+        try:
+            return conn.execute(query_str, params).fetchall()
+        except sqlite3.Error as e:
+            err('Cannot get run select query: ' + str(e))
+            return None
+
+
+def _format_timestamp(dt):
+    return dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def mark_leavers(clan_tag, players_in_clan):
+    with connection() as conn:
+        try:
+            with conn:
+                conn.execute(QUERY_MARK_LEAVERS, (json.dumps(list(players_in_clan)), clan_tag))
+        except sqlite3.Error as e:
+            err('Cannot execute database query: ' + str(e))
+
+
+# see db.save_war_data
+def save_war_data(clan, players, battles, cursors):
+    if not players:
+        return None
+    clan_tag = clan[0]
+    with connection() as conn:
+        try:
+            # the connection context manager commits the transaction, or rolls it back on error
+            with conn:
+                conn.execute(QUERY_UPSERT_CLAN, clan)
+                conn.executemany(QUERY_UPSERT_PLAYERS, [p + (clan_tag,) for p in players])
+                player_ids = dict(conn.execute(QUERY_GET_PLAYER_IDS, (json.dumps([p[0] for p in players]),)))
+                # changes made by the trigger are not counted in rowcount
+                inserted = conn.executemany(QUERY_INSERT_BATTLE,
+                                            [(clan_tag, player_ids[b[0]], _format_timestamp(b[1])) + tuple(b[2:])
+                                             for b in battles]).rowcount if battles else 0
+                conn.executemany(QUERY_UPDATE_BATTLE_CURSOR,
+                                 [{'id': player_ids[tag], 'ts': _format_timestamp(timestamp)}
+                                  for tag, timestamp in cursors.items()])
+            metrics.inc('war_battles_inserted', inserted)
+            metrics.inc('war_battles_duplicated', len(battles) - inserted)
+            return player_ids
+        except sqlite3.Error as e:
+            err('Cannot save war data: ' + str(e))
+            return None
+
+
+# returns timestamps of the latest battles already saved for players: {player tag: datetime}
+def get_battle_cursors(player_tags):
+    res = _fetch_query(QUERY_GET_BATTLE_CURSORS, (json.dumps(list(player_tags)),))
+    return {tag: datetime.datetime.fromisoformat(ts) for tag, ts in res} if res else {}
+
+
+def get_player_battle_counts(war_day):
+    res = _fetch_query(QUERY_GET_PLAYER_BATTLE_COUNTS, (war_day,))
+    return dict(res) if res else {}
+
+
+# see db.sync_notification_ids
+def sync_notification_ids(mapping):
+    with connection() as conn:
+        try:
+            with conn:
+                return conn.execute(QUERY_SYNC_NOTIFICATION_IDS,
+                                    (json.dumps([(tag,) + tuple(ids) for tag, ids in mapping.items()]),)).rowcount
+        except sqlite3.Error as e:
+            err('Error updating notification ids: ' + str(e))
+            return None
+
+
+def get_war_day_stats(clan_tag, war_day):
+    return _fetch_query(QUERY_GET_WAR_DAY_STATS, {'clan': clan_tag, 'day': war_day})
+
+
+# is_in_clan and is_mini are returned as booleans as they are by Postgres
+def get_war_day_player_stats(clan_tag, war_day):
+    res = _fetch_query(QUERY_GET_WAR_DAY_PLAYER_STATS, {'clan': clan_tag, 'day': war_day})
+    return [(name, discord_id, bool(is_in_clan), bool(is_mini), used)
+            for name, discord_id, is_in_clan, is_mini, used in res] if res is not None else None
+
+
+# see db.get_player_war_days, war days are returned as dates
+def get_player_war_days(clan_tag, since):
+    res = _fetch_query(QUERY_GET_PLAYER_WAR_DAYS, {'clan': clan_tag, 'day': since})
+    return [(datetime.date.fromisoformat(war_day) if war_day else None, played, won, player_id, name,
+             bool(is_in_clan)) for war_day, played, won, player_id, name, is_in_clan in res] \
+        if res is not None else None
@@ -0,0 +1,174 @@
+# Run instrumentation: counters and duration histograms, optionally labelled, e.g.
+# inc('war_battles_inserted', 10) or `with timer('stage_seconds', stage='export'): ...`
+# Metrics are kept for the process lifetime; they are dumped as JSON to METRICS_FILE at the end of every run and,
+# in daemon mode, served in Prometheus text format on METRICS_PORT (http://host:port/metrics)
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from decouple import config
+
+METRICS_FILE = config('METRICS_FILE', default='')
+METRICS_PORT = config('METRICS_PORT', default=0, cast=int)
+# prefix of the exported metric names
+PREFIX = 'crwar_'
+# histogram bucket upper bounds, seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+# (name, ((label, value), ...)) -> value
+_counters = {}
+# (name, ((label, value), ...)) -> Histogram
+_histograms = {}
+
+
+class Histogram:
+    __slots__ = ('bucket_counts', 'sum', 'count', 'last')
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+        # the latest observed value
+        self.last = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+        self.last = value
+
+
+def _get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _get_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    key = _get_key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+# observes the duration of the `with` block in seconds
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _format_labels(labels, extra=()):
+    labels = labels + extra
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+# returns the metrics in Prometheus text exposition format
+def get_prometheus_text():
+    lines = []
+    with _lock:
+        typed = set()
+        for (name, labels), value in sorted(_counters.items()):
+            if name not in typed:
+                lines.append('# TYPE %s%s_total counter' % (PREFIX, name))
+                typed.add(name)
+            lines.append('%s%s_total%s %s' % (PREFIX, name, _format_labels(labels), value))
+        for (name, labels), h in sorted(_histograms.items()):
+            if name not in typed:
+                lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS, h.bucket_counts):
+                cumulative += count
+                lines.append('%s%s_bucket%s %d' % (PREFIX, name, _format_labels(labels, (('le', bound),)), cumulative))
+            lines.append('%s%s_bucket%s %d' % (PREFIX, name, _format_labels(labels, (('le', '+Inf'),)), h.count))
+            lines.append('%s%s_sum%s %.6f' % (PREFIX, name, _format_labels(labels), h.sum))
+            lines.append('%s%s_count%s %d' % (PREFIX, name, _format_labels(labels), h.count))
+    return '\n'.join(lines) + '\n'
+
+
+# returns {'counters': [...], 'histograms': [...]}, every item has name and labels
+def get_json():
+    with _lock:
+        return {
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(_counters.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': h.count, 'sum': h.sum, 'last': h.last,
+                            'buckets': dict(zip(BUCKETS, h.bucket_counts))}
+                           for (name, labels), h in sorted(_histograms.items())],
+        }
+
+
+def dump(file_name=METRICS_FILE):
+    with open(file_name, 'w') as f:
+        json.dump(get_json(), f, indent=2)
+
+
+# returns {`label` value: (count, sum)} of `name` histograms, summed over the other labels
+def get_totals(name='stage_seconds', label='stage'):
+    res = {}
+    with _lock:
+        for (n, labels), h in _histograms.items():
+            if n == name:
+                value = dict(labels).get(label)
+                count, total = res.get(value, (0, 0))
+                res[value] = (count + h.count, total + h.sum)
+    return res
+
+
+# returns total durations of `name` histograms by `label` observed since `since` (get_totals result taken earlier),
+# e.g. 'clan 0.12s, players 1.30s'; so stages run for several clans are summed up
+def get_summary(since=None, name='stage_seconds', label='stage'):
+    since = since or {}
+    res = []
+    for value, (count, total) in get_totals(name, label).items():
+        since_count, since_total = since.get(value, (0, 0))
+        if count > since_count:
+            res.append('%s %.2fs' % (value, total - since_total))
+    return ', '.join(res)
+
+
+# serves the metrics on http://0.0.0.0:`port`/metrics from a background thread
+def start_http_server(port=METRICS_PORT):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = get_prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
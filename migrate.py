@@ -0,0 +1,97 @@
+# Applies database migrations from the `migrations` folder in order of their numbers,
+# every migration is applied once, in its own transaction
+# Usage:
+#   python migrate.py - apply all the new migrations
+#   python migrate.py --baseline <number> - mark migrations up to <number> as applied without running them,
+#       for databases where migrations were run manually
+import os
+import sys
+
+from decouple import config
+
+import db
+from utils import log, err
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+QUERY_CREATE_MIGRATION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migration (
+        version INT PRIMARY KEY,
+        applied_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc')
+    );
+"""
+QUERY_GET_APPLIED_MIGRATIONS = 'SELECT version FROM schema_migration;'
+QUERY_ADD_MIGRATION = 'INSERT INTO schema_migration (version) VALUES (%s);'
+QUERY_HAS_TABLE = 'SELECT to_regclass(%s) IS NOT NULL;'
+# settings available to migrations through current_setting()
+QUERY_SET_SETTING = 'SELECT set_config(%s, %s, false);'
+
+
+# returns sorted list of (version, file path)
+def get_migrations():
+    res = []
+    for name in os.listdir(MIGRATIONS_DIR):
+        version, ext = os.path.splitext(name)
+        if ext == '.sql' and version.isdigit():
+            res.append((int(version), os.path.join(MIGRATIONS_DIR, name)))
+    return sorted(res)
+
+
+# default clan tag is used to assign data saved before multi-clan support to a clan
+def set_settings(cur):
+    cur.execute(QUERY_SET_SETTING, ('crwar.clan_tag', config('CLAN_TAG', default='')))
+
+
+# applies migrations newer than the ones recorded in the database; with `baseline` set, migrations
+# up to that version are recorded without running
+# returns the number of applied migrations, or None if the database is not available or migration failed
+def migrate(baseline=None):
+    with db.connection() as conn:
+        if conn is None:
+            return None
+        cur = conn.cursor()
+        try:
+            set_settings(cur)
+            cur.execute(QUERY_HAS_TABLE, ('schema_migration',))
+            is_tracked = cur.fetchone()[0]
+            cur.execute(QUERY_HAS_TABLE, ('player',))
+            if not is_tracked and cur.fetchone()[0] and baseline is None:
+                err('Database schema exists but migrations are not tracked, run with --baseline <number> '
+                    'to mark migrations applied manually')
+                conn.rollback()
+                return None
+            cur.execute(QUERY_CREATE_MIGRATION_TABLE)
+            cur.execute(QUERY_GET_APPLIED_MIGRATIONS)
+            applied = set(r[0] for r in cur.fetchall())
+            conn.commit()
+
+            count = 0
+            for version, path in get_migrations():
+                if version in applied:
+                    continue
+                if baseline is not None and version <= baseline:
+                    log('Marking migration %03d as applied' % version)
+                else:
+                    log('Applying migration %03d' % version)
+                    with open(path, 'r') as f:
+                        cur.execute(f.read())
+                    count += 1
+                cur.execute(QUERY_ADD_MIGRATION, (version,))
+                conn.commit()
+            return count
+        except Exception as e:
+            conn.rollback()
+            err('Migration failed: ' + str(e))
+            return None
+        finally:
+            cur.close()
+
+
+if __name__ == '__main__':
+    baseline_version = None
+    if '--baseline' in sys.argv:
+        baseline_version = int(sys.argv[sys.argv.index('--baseline') + 1])
+    applied_count = migrate(baseline_version)
+    if applied_count is None:
+        sys.exit(1)
+    log('%d migrations applied' % applied_count)
@@ -0,0 +1 @@
+ALTER TABLE player ADD last_battle_timestamp TIMESTAMP NULL;
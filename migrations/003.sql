@@ -0,0 +1,2 @@
+-- report queries filter war_battle by war_day and group by player, the index covers them without reading the table
+CREATE INDEX war_battle_war_day_player_idx ON war_battle (war_day, player_id) INCLUDE (decks_used, decks_won);
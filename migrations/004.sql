@@ -0,0 +1,23 @@
+ALTER TABLE war_battle ADD is_boat_attack BOOL NOT NULL DEFAULT False;
+
+-- daily per-player totals, updated together with war_battle inserts, used by reports instead of raw battles
+CREATE TABLE player_war_day (
+	player_id INT NOT NULL,
+	war_day DATE NOT NULL,
+	played INT NOT NULL DEFAULT 0,
+	won INT NOT NULL DEFAULT 0,
+	fame INT NOT NULL DEFAULT 0,
+	boat_attacks INT NOT NULL DEFAULT 0,
+
+	PRIMARY KEY (player_id, war_day),
+	FOREIGN KEY (player_id)
+      REFERENCES player (id)
+);
+
+CREATE INDEX player_war_day_war_day_idx ON player_war_day (war_day, player_id) INCLUDE (played, won);
+
+-- boat attacks saved before are indistinguishable from lost battles, so they are not counted in boat_attacks
+INSERT INTO player_war_day (player_id, war_day, played, won, fame)
+SELECT player_id, war_day, SUM(decks_used), SUM(decks_won), SUM(COALESCE(fame, 0))
+FROM war_battle
+GROUP BY player_id, war_day;
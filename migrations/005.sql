@@ -0,0 +1,31 @@
+-- data saved before multiple clans were supported belongs to the clan from CLAN_TAG setting, migrate.py passes it
+-- as crwar.clan_tag
+DO $$
+BEGIN
+	IF COALESCE(current_setting('crwar.clan_tag', true), '') = '' THEN
+		RAISE EXCEPTION 'CLAN_TAG setting is required to assign existing data to a clan';
+	END IF;
+END $$;
+
+CREATE TABLE clan (
+	tag VARCHAR ( 12 ) PRIMARY KEY,
+	name VARCHAR ( 50 ) NOT NULL
+);
+
+INSERT INTO clan (tag, name) VALUES (current_setting('crwar.clan_tag'), current_setting('crwar.clan_tag'));
+
+-- the clan player was seen in during the last run
+ALTER TABLE player ADD clan_tag VARCHAR ( 12 ) NOT NULL DEFAULT current_setting('crwar.clan_tag') REFERENCES clan (tag);
+ALTER TABLE player ALTER clan_tag DROP DEFAULT;
+-- the clan the battle was played for
+ALTER TABLE war_battle ADD clan_tag VARCHAR ( 12 ) NOT NULL DEFAULT current_setting('crwar.clan_tag') REFERENCES clan (tag);
+ALTER TABLE war_battle ALTER clan_tag DROP DEFAULT;
+ALTER TABLE player_war_day ADD clan_tag VARCHAR ( 12 ) NOT NULL DEFAULT current_setting('crwar.clan_tag') REFERENCES clan (tag);
+ALTER TABLE player_war_day ALTER clan_tag DROP DEFAULT;
+
+CREATE INDEX player_clan_tag_idx ON player (clan_tag);
+
+ALTER TABLE player_war_day DROP CONSTRAINT player_war_day_pkey;
+ALTER TABLE player_war_day ADD PRIMARY KEY (clan_tag, player_id, war_day);
+DROP INDEX player_war_day_war_day_idx;
+CREATE INDEX player_war_day_war_day_idx ON player_war_day (clan_tag, war_day, player_id) INCLUDE (played, won);
@@ -0,0 +1,3 @@
+-- reports and notifications read player_war_day totals, so nothing queries war_battle by war day any more and the
+-- index only slows down battle inserts
+DROP INDEX IF EXISTS war_battle_war_day_player_idx;
@@ -0,0 +1,204 @@
+# Discord webhook notifications are posted by a background thread, so a slow or rate limited webhook doesn't delay
+# polling: messages are queued by send() and the caller continues right away
+# Messages longer than Discord limit are split into several ones, webhook rate limits are honored and failed
+# requests are retried; a notification identical to the previous one sent to the same webhook is skipped, the last
+# notifications are kept in NOTIFICATION_CACHE_FILE, so this works across one-shot runs too
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from decouple import config
+
+import metrics
+from utils import log, err
+
+# maximum length of a Discord message content
+MESSAGE_LIMIT = 2000
+DISCORD_TIMEOUT = config('DISCORD_TIMEOUT', default=10, cast=float)
+DISCORD_MAX_RETRIES = config('DISCORD_MAX_RETRIES', default=5, cast=int)
+NOTIFICATION_CACHE_FILE = config('NOTIFICATION_CACHE_FILE', default='.notification_cache.json')
+# exponential backoff for server side and connection errors: BACKOFF_BASE * 2 ^ attempt seconds
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+
+# splits `message` into parts of no more than `limit` characters, by lines when possible
+def split_message(message, limit=MESSAGE_LIMIT):
+    res = []
+    current = ''
+    for line in message.splitlines(keepends=True):
+        if len(current) + len(line) > limit and current:
+            res.append(current)
+            current = ''
+        while len(line) > limit:
+            res.append(line[:limit])
+            line = line[limit:]
+        current += line
+    if current:
+        res.append(current)
+    return res
+
+
+class Notifier:
+    def __init__(self, timeout=DISCORD_TIMEOUT, max_retries=DISCORD_MAX_RETRIES, cache_file=NOTIFICATION_CACHE_FILE):
+        self.timeout = timeout
+        self.cache_file = cache_file
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/json"})
+        # queued (url, message, report url, key) and the number of notifications not delivered yet
+        self.queue = deque()
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        # the rest is used by the worker thread only
+        # webhook url hash -> key hash of the last delivered notification, loaded from cache_file on the first use;
+        # hashes are stored, so that the file keeps neither webhook tokens nor messages
+        self.last_keys = None
+        # no requests are made until this time (time.monotonic) when the webhook rate limit is reached
+        self.paused_until = 0
+
+    # queues notification to the webhook `url`, the full report link `report_url` is attached to the last message;
+    # notification is skipped if its `key` (the message by default) is the same as of the previous one
+    def send(self, url, message, report_url=None, key=None):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='notifier', daemon=True)
+                self.thread.start()
+            self.queue.append((url, message, report_url, message if key is None else key))
+            self.pending += 1
+            self.condition.notify_all()
+
+    # waits up to `timeout` seconds for the queued notifications to be delivered, returns True if all of them are
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                notification = self.queue.popleft()
+            try:
+                self._deliver(*notification)
+            except Exception as e:
+                err('Cannot send notification message: ' + str(e))
+            finally:
+                with self.condition:
+                    self.pending -= 1
+                    self.condition.notify_all()
+
+    @staticmethod
+    def _hash(s):
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def _load_last_keys(self):
+        if self.last_keys is None:
+            self.last_keys = {}
+            if self.cache_file:
+                try:
+                    with open(self.cache_file, 'r') as f:
+                        self.last_keys = json.load(f)
+                except (IOError, ValueError):
+                    pass
+        return self.last_keys
+
+    def _save_last_keys(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file + '.tmp', 'w') as f:
+                json.dump(self.last_keys, f)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except OSError as e:
+            err('Cannot save notification cache: ' + str(e))
+
+    def _deliver(self, url, message, report_url, key):
+        url_hash, key_hash = self._hash(url), self._hash(key)
+        if self._load_last_keys().get(url_hash) == key_hash:
+            log('Notification is the same as the previous one, skipping')
+            metrics.inc('notifications_skipped')
+            return
+        parts = split_message(message)
+        for i, part in enumerate(parts):
+            payload = {"content": part}
+            if report_url and i == len(parts) - 1:
+                payload["embeds"] = [{"title": "Full report", "url": report_url}]
+            if not self._post(url, payload):
+                metrics.inc('notifications_failed')
+                err('Notification is not sent, %d of %d messages delivered' % (i, len(parts)))
+                return
+        self.last_keys[url_hash] = key_hash
+        self._save_last_keys()
+        metrics.inc('notifications_sent')
+        log('Notification sent in %d messages' % len(parts))
+
+    # returns True if the message is posted
+    def _post(self, url, payload):
+        for attempt in range(self.max_retries + 1):
+            wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                with metrics.timer('discord_post_seconds'):
+                    r = self.session.post(url, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+                delay = self._get_backoff(attempt)
+            else:
+                self._update_rate_limit(r)
+                if r.ok:
+                    return True
+                error = 'status %d' % r.status_code
+                if r.status_code == 429:
+                    delay = self._get_retry_after(r)
+                elif r.status_code >= 500:
+                    delay = self._get_backoff(attempt)
+                else:
+                    err('Discord returned %d: %s' % (r.status_code, r.text))
+                    return False
+            if attempt == self.max_retries:
+                err('Discord request failed (%s)' % error)
+                return False
+            log('Discord request failed (%s), retrying in %.1fs' % (error, delay))
+            time.sleep(delay)
+
+    @staticmethod
+    def _get_backoff(attempt):
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+
+    # Discord reports the time to wait in seconds in the response body and Retry-After header
+    @staticmethod
+    def _get_retry_after(response):
+        try:
+            return float(response.json()["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            pass
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            return BACKOFF_BASE
+
+    # when no requests are left in the current rate limit bucket, the next one waits for the bucket reset
+    def _update_rate_limit(self, response):
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            try:
+                reset_after = float(response.headers["X-RateLimit-Reset-After"])
+            except (KeyError, ValueError):
+                return
+            self.paused_until = max(self.paused_until, time.monotonic() + reset_after)
+
+
+notifier = Notifier()
@@ -0,0 +1,113 @@
+# Adaptive per-player polling: the battlelog keeps only the last BATTLELOG_SIZE battles of any type, so players who
+# play a lot have to be polled more often than idle ones not to lose war battles. Battle rate of every player is
+# estimated from the war battles saved during the last days and from how many new battles appear in the battlelog
+# between polls; the player is polled when about BATTLELOG_FILL part of the battlelog is expected to be replaced.
+# Intervals are stretched evenly if polling everybody that often would exceed BATTLELOG_POLL_BUDGET.
+import datetime
+import threading
+
+from decouple import config
+
+import storage
+from utils import log
+
+BATTLELOG_SIZE = 25
+BATTLELOG_FILL = 0.5
+MIN_INTERVAL = datetime.timedelta(minutes=config('PLAYER_POLL_MIN_INTERVAL', default=10, cast=int))
+MAX_INTERVAL = datetime.timedelta(minutes=config('PLAYER_POLL_MAX_INTERVAL', default=120, cast=int))
+# battlelog requests per hour for all the tracked players
+BATTLELOG_POLL_BUDGET = config('BATTLELOG_POLL_BUDGET', default=1500, cast=int)
+# the number of days of war history used for the initial rate estimate
+HISTORY_DAYS = 7
+# weight of the latest observation in the battle rate moving average
+RATE_SMOOTHING = 0.3
+# when the whole battlelog is new, some battles might have been missed, so the rate is likely higher than observed
+OVERFLOW_FACTOR = 2
+
+
+# kept for every tracked player while they are a member of one of the tracked clans
+class PlayerPollState:
+    __slots__ = ('rate', 'last_poll', 'last_battle_time', 'next_poll', 'last_seen')
+
+    def __init__(self):
+        # estimated battles per hour
+        self.rate = 0
+        self.last_poll = None
+        self.last_battle_time = None
+        self.next_poll = None
+        # the last time the player was listed among clan members
+        self.last_seen = None
+
+
+class PollScheduler:
+    def __init__(self):
+        self.players = dict()
+        self.lock = threading.Lock()
+
+    def _get_state(self, player_tag):
+        if player_tag not in self.players:
+            self.players[player_tag] = PlayerPollState()
+        return self.players[player_tag]
+
+    # sets initial battle rates from the war battles saved during the last HISTORY_DAYS days
+    def load_history(self, now):
+        since = (now - datetime.timedelta(days=HISTORY_DAYS)).strftime('%Y-%m-%d')
+        battle_counts = storage.get_player_battle_counts(since)
+        with self.lock:
+            for player_tag, battles in battle_counts.items():
+                state = self._get_state(player_tag)
+                state.rate = battles / (HISTORY_DAYS * 24)
+                state.last_seen = now
+        log('Battle rate history loaded for %d players' % len(battle_counts))
+
+    # returns tags of the players that should be polled now; all of them with `poll_all` set
+    # `player_tags` are the current clan members
+    def get_due(self, player_tags, now, poll_all=False):
+        with self.lock:
+            res = set()
+            for t in player_tags:
+                state = self._get_state(t)
+                state.last_seen = now
+                if poll_all or state.next_poll is None or state.next_poll <= now:
+                    res.add(t)
+            return res
+
+    # updates player's battle rate from the loaded battlelog (newest battles first, as API returns it)
+    # and returns True if some battles might have been lost since the previous poll
+    def observe(self, player_tag, battle_times, now):
+        with self.lock:
+            state = self._get_state(player_tag)
+            overflow = False
+            if state.last_poll is not None and state.last_battle_time is not None and now > state.last_poll:
+                new_battles = sum(1 for t in battle_times if t > state.last_battle_time)
+                overflow = new_battles >= BATTLELOG_SIZE
+                observed_rate = new_battles * (OVERFLOW_FACTOR if overflow else 1) / \
+                    ((now - state.last_poll).total_seconds() / 3600)
+                state.rate = RATE_SMOOTHING * observed_rate + (1 - RATE_SMOOTHING) * state.rate
+            state.last_poll = now
+            if battle_times:
+                state.last_battle_time = battle_times[0]
+            state.next_poll = now + self._get_interval(state.rate)
+            return overflow
+
+    @staticmethod
+    def _get_interval(rate):
+        if rate <= 0:
+            return MAX_INTERVAL
+        interval = datetime.timedelta(hours=BATTLELOG_SIZE * BATTLELOG_FILL / rate)
+        return max(MIN_INTERVAL, min(MAX_INTERVAL, interval))
+
+    # forgets the players who haven't been clan members for MAX_INTERVAL (left the clan), then stretches planned
+    # polls if the players would be polled more often than the budget allows
+    def apply_budget(self, now):
+        with self.lock:
+            self.players = {t: s for t, s in self.players.items() if s.last_seen >= now - MAX_INTERVAL}
+            polled = [s for s in self.players.values() if s.last_poll is not None]
+            requests_per_hour = sum(3600 / self._get_interval(s.rate).total_seconds() for s in polled)
+            if requests_per_hour <= BATTLELOG_POLL_BUDGET:
+                return
+            scale = requests_per_hour / BATTLELOG_POLL_BUDGET
+            for s in polled:
+                s.next_poll = s.last_poll + self._get_interval(s.rate) * scale
+            log('Battlelog polls need %d requests per hour, intervals are stretched %.2f times to fit the budget' %
+                (requests_per_hour, scale))
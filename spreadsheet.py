@@ -1,43 +1,148 @@
 from __future__ import print_function
 
+import json
 import os.path
+import time
 
 from decouple import config
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 EXPORT_RANGE_NAME = 'Stats'
 MAPPING_RANGE_NAME = 'Players!A:C'
+# last exported values of every sheet, used to send only changed cells
+EXPORT_CACHE_DIR = config('EXPORT_CACHE_DIR', default='.export_cache')
+# hours between full rewrites of a sheet
+FULL_EXPORT_INTERVAL = config('FULL_EXPORT_INTERVAL', default=24, cast=float)
+# minutes the Players mapping is reused for without downloading it again
+MAPPING_CACHE_TTL = config('MAPPING_CACHE_TTL', default=60, cast=float)
 
 
+_spreadsheets = None
+# (fetch time, values) of the Players mapping
+_mapping_cache = None
+
+
+# the service is built once per process, from the discovery document bundled with the client library
 def _get_spreadsheets():
-    secret_file = os.path.join(os.getcwd(), 'client_secret.json')
-    credentials = service_account.Credentials.from_service_account_file(secret_file, scopes=SCOPES)
-    service = build('sheets', 'v4', credentials=credentials)
+    global _spreadsheets
+    if _spreadsheets is None:
+        # Google API client takes a while to import, so it is loaded only when the spreadsheet is accessed
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+        secret_file = os.path.join(os.getcwd(), 'client_secret.json')
+        credentials = service_account.Credentials.from_service_account_file(secret_file, scopes=SCOPES)
+        service = build('sheets', 'v4', credentials=credentials, cache_discovery=False, static_discovery=True)
+        _spreadsheets = service.spreadsheets()
+    return _spreadsheets
+
+
+# name of the column with zero based index `idx`, e.g. 0 -> A, 26 -> AA
+def _get_column_name(idx):
+    res = ''
+    idx += 1
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        res = chr(ord('A') + rem) + res
+    return res
+
+
+def _get_a1_range(sheet_name, row, first_col, last_col):
+    return "'%s'!%s%d:%s%d" % (sheet_name.replace("'", "''"), _get_column_name(first_col), row + 1,
+                               _get_column_name(last_col), row + 1)
+
+
+def _get_export_cache_file(range_name):
+    return os.path.join(EXPORT_CACHE_DIR, range_name + '.json')
+
+
+def _load_export_cache(range_name):
+    try:
+        with open(_get_export_cache_file(range_name), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _save_export_cache(range_name, cache):
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    with open(_get_export_cache_file(range_name), 'w') as f:
+        json.dump(cache, f)
+
+
+# returns [(row, first column, values)] for every run of adjacent cells that differ in `old` and `new`,
+# cells missing in `new` are cleared
+def _get_changed_ranges(old, new):
+    res = []
+    for i in range(max(len(old), len(new))):
+        old_row = old[i] if i < len(old) else []
+        new_row = new[i] if i < len(new) else []
+        width = max(len(old_row), len(new_row))
+        old_row = old_row + [''] * (width - len(old_row))
+        new_row = new_row + [''] * (width - len(new_row))
+        j = 0
+        while j < width:
+            if old_row[j] == new_row[j]:
+                j += 1
+                continue
+            start = j
+            while j < width and old_row[j] != new_row[j]:
+                j += 1
+            res.append((i, start, new_row[start:j]))
+    return res
 
-    return service.spreadsheets()
 
+# writes `data` to the sheet `range_name`: the last exported values are kept in EXPORT_CACHE_DIR and only the
+# changed cells are sent in one batch update; the whole sheet is rewritten on the first export and every
+# FULL_EXPORT_INTERVAL hours in case it was edited by hand
+# returns the number of updated cells
+def export_to_sheet(data, range_name=EXPORT_RANGE_NAME):
+    # None cells are skipped by the API, empty strings clear them
+    values = [['' if v is None else v for v in row] for row in data]
+    spreadsheet_id = config('SPREADSHEET_ID')
+    cache = _load_export_cache(range_name)
+    now = time.time()
 
-def export_to_sheet(data):
-    sheet = _get_spreadsheets()
+    if cache is None or cache['spreadsheet_id'] != spreadsheet_id \
+            or now - cache['exported_at'] > FULL_EXPORT_INTERVAL * 3600:
+        sheet = _get_spreadsheets()
+        sheet.values().clear(
+            spreadsheetId=spreadsheet_id,
+            range=range_name
+        ).execute()
+        sheet.values().update(
+            spreadsheetId=spreadsheet_id,
+            valueInputOption='RAW',
+            range=range_name,
+            body=dict(
+                majorDimension='ROWS',
+                values=values)
+        ).execute()
+        cells = sum(len(row) for row in values)
+        exported_at = now
+    else:
+        changes = _get_changed_ranges(cache['values'], values)
+        if changes:
+            _get_spreadsheets().values().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body=dict(
+                    valueInputOption='RAW',
+                    data=[dict(range=_get_a1_range(range_name, row, col, col + len(v) - 1), majorDimension='ROWS',
+                               values=[v]) for row, col, v in changes])
+            ).execute()
+        cells = sum(len(v) for _, _, v in changes)
+        exported_at = cache['exported_at']
 
-    sheet.values().clear(
-        spreadsheetId=config('SPREADSHEET_ID'),
-        range=EXPORT_RANGE_NAME
-    ).execute()
-    sheet.values().update(
-        spreadsheetId=config('SPREADSHEET_ID'),
-        valueInputOption='RAW',
-        range=EXPORT_RANGE_NAME,
-        body=dict(
-            majorDimension='ROWS',
-            values=data)
-    ).execute()
+    _save_export_cache(range_name, dict(spreadsheet_id=spreadsheet_id, exported_at=exported_at, values=values))
+    return cells
 
 
+# the mapping is downloaded again only when the cached one is older than MAPPING_CACHE_TTL minutes
 def get_notifications_mapping():
-    sheet = _get_spreadsheets()
-    result = sheet.values().get(spreadsheetId=config('SPREADSHEET_ID'),
-                                range=MAPPING_RANGE_NAME).execute()
-    return result.get('values', [])
+    global _mapping_cache
+    now = time.monotonic()
+    if _mapping_cache is None or now - _mapping_cache[0] > MAPPING_CACHE_TTL * 60:
+        sheet = _get_spreadsheets()
+        result = sheet.values().get(spreadsheetId=config('SPREADSHEET_ID'),
+                                    range=MAPPING_RANGE_NAME).execute()
+        _mapping_cache = (now, result.get('values', []))
+    return _mapping_cache[1]
@@ -0,0 +1,165 @@
+# Storage used by the reports: DB_BACKEND selects `postgres` (db.py, the default) or `sqlite` (db_sqlite.py, a local
+# database file for small deployments and machines without Postgres server). Both backend modules implement:
+# mark_leavers, save_war_data, get_battle_cursors, get_player_battle_counts, sync_notification_ids,
+# get_war_day_stats, get_war_day_player_stats and get_player_war_days
+# Reports are built here from get_player_war_days rows, the same way for all the backends
+# numpy is imported by the report functions, so that the modules importing storage stay fast to start
+import datetime
+import math
+
+from decouple import config
+
+DB_BACKEND = config('DB_BACKEND', default='postgres')
+if DB_BACKEND == 'sqlite':
+    import db_sqlite as backend
+elif DB_BACKEND == 'postgres':
+    import db as backend
+else:
+    raise ValueError('Unknown DB_BACKEND ' + DB_BACKEND)
+
+# number of the last war days (one war week) the season win rate trend is computed for
+TREND_WAR_DAYS = 4
+
+
+def mark_leavers(clan_tag, players_in_clan):
+    return backend.mark_leavers(clan_tag, players_in_clan)
+
+
+def save_war_data(clan, players, battles, cursors):
+    return backend.save_war_data(clan, players, battles, cursors)
+
+
+def get_battle_cursors(player_tags):
+    return backend.get_battle_cursors(player_tags)
+
+
+def get_player_battle_counts(war_day):
+    return backend.get_player_battle_counts(war_day)
+
+
+def sync_notification_ids(mapping):
+    return backend.sync_notification_ids(mapping)
+
+
+def get_war_day_stats(clan_tag, war_day):
+    return backend.get_war_day_stats(clan_tag, war_day)
+
+
+def get_war_day_player_stats(clan_tag, war_day):
+    return backend.get_war_day_player_stats(clan_tag, war_day)
+
+
+# maps per player war day rows of get_player_war_days onto players x days matrices, `first_day` being
+# the first column; returns player names and played, won and has data matrices
+def _get_player_day_matrix(rows, first_day, days):
+    import numpy as np
+    # query result has a row per player's war day (or one row with no war day for players without battles),
+    # ordered by player, so a new matrix row starts whenever player id changes
+    player_ids = np.fromiter((row[3] for row in rows), dtype=np.int64, count=len(rows))
+    is_first_row = np.ones(len(rows), dtype=bool)
+    is_first_row[1:] = player_ids[1:] != player_ids[:-1]
+    player_idx = np.cumsum(is_first_row) - 1
+    names = [rows[i][4] + (' (not in clan)' if not rows[i][5] else '') for i in np.flatnonzero(is_first_row)]
+
+    war_days = np.array([row[0] for row in rows], dtype='datetime64[D]')
+    day_idx = (war_days - np.datetime64(first_day, 'D')).astype(np.int64)
+    has_day = ~np.isnat(war_days) & (day_idx >= 0) & (day_idx < days)
+
+    played = np.zeros((len(names), days), dtype=np.int64)
+    won = np.zeros_like(played)
+    has_data = np.zeros(played.shape, dtype=bool)
+    player_idx, day_idx = player_idx[has_day], day_idx[has_day]
+    played[player_idx, day_idx] = np.fromiter((row[1] or 0 for row in rows), dtype=np.int64, count=len(rows))[has_day]
+    won[player_idx, day_idx] = np.fromiter((row[2] or 0 for row in rows), dtype=np.int64, count=len(rows))[has_day]
+    has_data[player_idx, day_idx] = True
+    return names, played, won, has_data
+
+
+# returns two-dimensional array for export. Format:
+# [[Report date][<datetime>]]
+# [[Player][Played <date (Sun)>][Won <date (Sun)>]...[Played <date (today)>][Won <date (today)>]]
+# first rows are dates header, played/won header and totals, then a row per player with the number of battles
+# played and won on every day of the report
+def get_report(clan_tag, cutout_date):
+    import numpy as np
+    rows = backend.get_player_war_days(clan_tag, cutout_date)
+    if rows is None:
+        return None
+    cutout_day = datetime.datetime.strptime(cutout_date, '%Y-%m-%d').date()
+    today = datetime.datetime.utcnow()
+    days_in_report = (today.date() - cutout_day).days + 1
+    names, played, won, has_data = _get_player_day_matrix(rows, cutout_day, days_in_report)
+
+    width = 1 + days_in_report * 2
+    header = np.full((3, width), None, dtype=object)
+    header[0, 0] = 'Last update: ' + today.strftime('%d-%m-%Y %H:%M:%S')
+    header[0, 1::2] = [(cutout_day + datetime.timedelta(days=d)).strftime('%d-%m-%Y') for d in range(days_in_report)]
+    header[1, 1::2] = 'played'
+    header[1, 2::2] = 'won'
+
+    # counting totals and averages
+    header[2, 0] = 'TOTAL'
+    day_played = played.sum(axis=0)
+    day_won = won.sum(axis=0)
+    day_players = (played > 0).sum(axis=0)
+    for d in np.flatnonzero(day_played):
+        # maximum number of battles per clan per day is 50 * 4 = 200, print % of those that are actually played
+        header[2, 1 + d * 2] = str(round(100 * day_played[d] / 200, 2)) + '% (' + str(day_players[d]) + ')'
+        header[2, 2 + d * 2] = str(round(100 * day_won[d] / day_played[d], 2)) + '%'
+
+    table = np.full((len(names), width), None, dtype=object)
+    table[:, 0] = names
+    # astype(object) gives python ints that can be serialized to JSON
+    table[:, 1::2] = np.where(has_data, played.astype(object), None)
+    table[:, 2::2] = np.where(has_data, won.astype(object), None)
+
+    return header.tolist() + table.tolist()
+
+
+def _format_percent(value):
+    return None if math.isnan(value) else str(round(100 * value, 2)) + '%'
+
+
+# per player summary since `start_date` (season start): war days participated, decks used and won, participation
+# streaks and win rate trend, i.e. win rate during the last TREND_WAR_DAYS war days compared to the days before
+def get_season_summary(clan_tag, start_date):
+    import numpy as np
+    rows = backend.get_player_war_days(clan_tag, start_date)
+    if rows is None:
+        return None
+    start_day = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+    today = datetime.datetime.utcnow()
+    names, played, won, has_data = _get_player_day_matrix(rows, start_day, (today.date() - start_day).days + 1)
+
+    # war days are the days anyone of the clan battled on, training days are skipped this way
+    war_days = np.flatnonzero(has_data.any(axis=0))
+    played, won = played[:, war_days], won[:, war_days]
+    participated = played > 0
+
+    current_streak = np.zeros(len(names), dtype=np.int64)
+    longest_streak = np.zeros(len(names), dtype=np.int64)
+    for day in participated.T:
+        current_streak = (current_streak + 1) * day
+        longest_streak = np.maximum(longest_streak, current_streak)
+
+    total_played = played.sum(axis=1)
+    total_won = won.sum(axis=1)
+    recent_played = played[:, -TREND_WAR_DAYS:].sum(axis=1)
+    recent_won = won[:, -TREND_WAR_DAYS:].sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        participation = participated.sum(axis=1) / len(war_days)
+        win_rate = total_won / total_played
+        recent_win_rate = recent_won / recent_played
+        previous_win_rate = (total_won - recent_won) / (total_played - recent_played)
+    trend = recent_win_rate - previous_win_rate
+
+    res = [['Season since %s, last update: %s' % (start_day.strftime('%d-%m-%Y'),
+                                                  today.strftime('%d-%m-%Y %H:%M:%S'))],
+           ['player', 'war days', 'participation', 'played', 'won', 'win rate', 'streak', 'longest streak',
+            'win rate trend']]
+    for i, name in enumerate(names):
+        res.append([name, int(participated[i].sum()), _format_percent(participation[i]), int(total_played[i]),
+                    int(total_won[i]), _format_percent(win_rate[i]), int(current_streak[i]),
+                    int(longest_streak[i]),
+                    None if np.isnan(trend[i]) else ('+' if trend[i] >= 0 else '') + _format_percent(trend[i])])
+    return res